@@ -0,0 +1,255 @@
+# asyncio engine for build steps; needs python 3.5+, import it lazily
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+if __package__:
+    from . import runner, scheduler
+else:
+    import runner
+    import scheduler
+
+_logger = logging.getLogger(
+    __package__ or os.path.basename(__file__))
+
+KILL_TIMEOUT = 5.0
+
+
+def _kill_tree(proc, sig=None):
+    if proc.returncode is not None:
+        return
+    try:
+        if sys.platform == "win32":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(proc.pid, sig or signal.SIGTERM)
+    except (OSError, ProcessLookupError):
+        pass
+
+
+async def _terminate(proc):
+    _kill_tree(proc)
+    try:
+        await asyncio.wait_for(proc.wait(), KILL_TIMEOUT)
+    except asyncio.TimeoutError:
+        _kill_tree(proc, getattr(signal, "SIGKILL", None))
+        await proc.wait()
+
+
+async def _readline(stream):
+    try:
+        return await stream.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        return await stream.read(e.consumed)
+
+
+async def run(cmd,
+              cwd=None,
+              env=None,
+              log_file=None,
+              on_line=None,
+              tail_lines=runner.TAIL_LINES,
+              check=True,
+              pass_fds=()):
+    kwargs = {}
+    if pass_fds:
+        kwargs["pass_fds"] = pass_fds
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        # own process group, so the whole tree can be killed on cancel
+        kwargs["start_new_session"] = True
+
+    tail = collections.deque(maxlen=tail_lines)
+    log = open(log_file, "wb") if log_file else None
+    try:
+        start = time.time()
+        proc = await asyncio.create_subprocess_shell(
+            cmd,
+            cwd=cwd,
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=runner.MAX_LINE,
+            **kwargs)
+        try:
+            while True:
+                line = await _readline(proc.stdout)
+                if not line:
+                    break
+                if log is not None:
+                    log.write(line)
+                tail.append(line)
+                if on_line is not None:
+                    on_line(line)
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            _logger.warning("killing %s", cmd)
+            await _terminate(proc)
+            raise
+        elapsed = time.time() - start
+        if log is not None:
+            log.write(("\n# exit %d after %.3fs\n" % (
+                returncode, elapsed)).encode("utf-8"))
+    finally:
+        if log is not None:
+            log.close()
+
+    result = runner.StepResult(cmd, returncode, elapsed, log_file, list(tail))
+    _logger.debug("%s", result)
+    if check and returncode:
+        raise runner.StepFailed(result)
+    return result
+
+
+class CellRunner:
+    def __init__(self, prepare, start_step, finish_step, fail_step,
+                 step_output, recorder, tail_lines=runner.TAIL_LINES,
+                 finish_cell=None, jobserver=None):
+        self.prepare = prepare
+        self.start_step = start_step
+        self.finish_step = finish_step
+        self.fail_step = fail_step
+        self.step_output = step_output
+        self.recorder = recorder
+        self.tail_lines = tail_lines
+        self.finish_cell = finish_cell
+        self.jobserver = jobserver
+        # waiting for a token blocks, like a child make does; one thread of
+        # its own does that, so waiting cells cannot starve prepare() of the
+        # default executor
+        self._tokens = None
+        if jobserver is not None:
+            self._tokens = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def __call__(self, cell):
+        if self.jobserver is None:
+            return await self.run_cell(cell)
+        future = self._tokens.submit(self.jobserver.acquire)
+        try:
+            token = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # the token may still arrive, hand it straight back
+            future.add_done_callback(self._release)
+            raise
+        try:
+            return await self.run_cell(cell)
+        finally:
+            self.jobserver.release(token)
+
+    def _release(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.jobserver.release(future.result())
+
+    def close(self):
+        if self._tokens is not None:
+            self._tokens.shutdown(wait=False)
+
+    async def run_cell(self, cell):
+        loop = asyncio.get_event_loop()
+        pass_fds = self.jobserver.fds if self.jobserver is not None else ()
+        with self.recorder.cell(cell):
+            failed = True
+            try:
+                # settings and toolchain resolution are blocking, keep them
+                # off the event loop
+                steps = await loop.run_in_executor(None, self.prepare, cell)
+                for step in steps:
+                    with self.recorder.phase(step.name, step.cell):
+                        self.start_step(step)
+                        try:
+                            result = await run(step.cmd,
+                                               cwd=step.cwd,
+                                               env=step.env,
+                                               log_file=os.path.join(
+                                                   step.cwd,
+                                                   "%s.log" % step.name),
+                                               on_line=self.step_output(step),
+                                               tail_lines=self.tail_lines,
+                                               pass_fds=pass_fds)
+                        except runner.StepFailed as e:
+                            self.fail_step(step, e.result)
+                            raise
+                        self.finish_step(step, result)
+                _logger.info("[%s] done", cell, extra={"cell": cell})
+                failed = False
+            finally:
+                if self.finish_cell is not None:
+                    self.finish_cell(cell, failed)
+
+
+async def _run_jobs(graph, func, num_workers, keep_going, priority=None):
+    semaphore = asyncio.Semaphore(num_workers)
+    failures = []
+    blocked = set()
+    stopped = []
+    tasks = {}
+
+    async def run_job(job):
+        deps = [tasks[x] for x in graph.depends[job]]
+        if deps and not all(await asyncio.gather(*deps)):
+            blocked.add(job)
+            return False
+        async with semaphore:
+            if stopped:
+                return False
+            try:
+                await func(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _logger.error("%s failed: %s", job, e, extra={"cell": job})
+                failures.append((job, e))
+                if not keep_going:
+                    stopped.append(job)
+                return False
+        return True
+
+    # dependencies come first, so their tasks exist when a job is created;
+    # with priority the heavier of the jobs ready together queue first
+    for job in graph.toposort(priority):
+        tasks[job] = asyncio.ensure_future(run_job(job))
+    await asyncio.gather(*tasks.values())
+    return failures, blocked
+
+
+def run_jobs(jobs, func, num_workers=1, keep_going=False, depends=None,
+             priority=None):
+    graph = scheduler.Graph(jobs, depends)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    main = loop.create_task(
+        _run_jobs(graph, func, max(1, num_workers or 1), keep_going,
+                  priority))
+    try:
+        try:
+            failures, blocked = loop.run_until_complete(main)
+        except KeyboardInterrupt:
+            _logger.warning("interrupted, cancelling running steps")
+            main.cancel()
+            try:
+                loop.run_until_complete(main)
+            except asyncio.CancelledError:
+                pass
+            raise
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+    for job in graph.jobs:
+        if job in blocked:
+            _logger.warning("%s skipped, a dependency failed", job,
+                            extra={"cell": job})
+    if failures:
+        raise scheduler.JobsFailed(
+            failures, [x for x in graph.jobs if x in blocked])
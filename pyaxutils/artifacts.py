@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+
+if __package__:
+    from . import fingerprint, utils
+else:
+    import fingerprint
+    import utils
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+CACHE_DIR = os.path.join(utils.CACHE_DIR, "artifacts")
+MAX_SIZE = 10 * 1024 ** 3
+# left in a restored tree while some of its files are cache hardlinks
+LINKS_FILENAME = ".artifact-links"
+
+# linux/fs.h, clones a file's extents on btrfs, xfs and friends
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        with open(src, "rb") as s:
+            with open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def copy_file(src, dst):
+    if _reflink(src, dst):
+        return "reflink"
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def link_file(src, dst):
+    if _reflink(src, dst):
+        return "reflink"
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except (AttributeError, OSError):
+        pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _walk(top, ignore):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name in ignore:
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                yield path, os.path.relpath(path, top).replace(os.sep, "/")
+
+
+def unshare(top):
+    # restored files may be hardlinks into the cache; give them their own
+    # inode before a step can write into one in place
+    marker = os.path.join(top, LINKS_FILENAME)
+    if not os.path.isfile(marker):
+        return
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                tmp = path + ".unshare.tmp"
+                shutil.copy2(path, tmp)
+                utils.replace(tmp, path)
+    os.remove(marker)
+
+
+class ArtifactCache:
+    def __init__(self, root=CACHE_DIR, max_size=MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _object(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _manifest(self, key):
+        return os.path.join(self.root, "entries", "%s.json" % key)
+
+    def _load(self, key):
+        try:
+            with open(self._manifest(key)) as fd:
+                return json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def has(self, key):
+        return os.path.isfile(self._manifest(key))
+
+    def store(self, key, trees, ignore=()):
+        ignore = set(ignore) | set([LINKS_FILENAME])
+        manifest = dict(created=time.time(), trees={})
+        for name, top in trees.items():
+            if not os.path.isdir(top):
+                continue
+            files = manifest["trees"][name] = []
+            for path, rel in _walk(top, ignore):
+                digest = fingerprint.hash_file(path)
+                obj = self._object(digest)
+                if not os.path.isfile(obj):
+                    if not os.path.isdir(os.path.dirname(obj)):
+                        os.makedirs(os.path.dirname(obj))
+                    tmp = "%s.%d.%d.tmp" % (obj, os.getpid(),
+                                            threading.current_thread().ident)
+                    # never a hardlink: the build dir keeps changing in place
+                    copy_file(path, tmp)
+                    utils.replace(tmp, obj)
+                files.append([rel, digest, os.path.getsize(obj)])
+
+        with utils.atomic_write(self._manifest(key)) as fd:
+            json.dump(manifest, fd, indent=1, sort_keys=True)
+        logger.debug("stored %s", key)
+        self.evict()
+
+    def restore(self, key, trees):
+        manifest = self._load(key)
+        if manifest is None:
+            return False
+        how = {}
+        try:
+            for name, files in manifest["trees"].items():
+                top = trees.get(name)
+                if top is None:
+                    continue
+                # written first, so a restore that fails halfway still
+                # gets its hardlinks unshared
+                marker = os.path.join(top, LINKS_FILENAME)
+                if not os.path.isdir(top):
+                    os.makedirs(top)
+                with open(marker, "w"):
+                    pass
+                linked = False
+                for rel, digest, size in files:
+                    dst = os.path.join(top, *rel.split("/"))
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    x = link_file(self._object(digest), dst)
+                    how[x] = how.get(x, 0) + 1
+                    linked = linked or x == "hardlink"
+                if not linked:
+                    os.remove(marker)
+        except (IOError, OSError) as e:
+            # an object evicted under us, the caller builds instead
+            logger.warning("cannot restore %s: %s", key, e)
+            return False
+        # last use decides what gets evicted first
+        os.utime(self._manifest(key), None)
+        logger.debug("restored %s (%s)", key, ", ".join(
+            "%d %s" % (n, x) for x, n in sorted(how.items())))
+        return True
+
+    def evict(self):
+        entries_dir = os.path.join(self.root, "entries")
+        with self._lock:
+            entries = []
+            refs = {}
+            sizes = {}
+            for name in os.listdir(entries_dir):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(entries_dir, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                    with open(path) as fd:
+                        manifest = json.load(fd)
+                except (IOError, OSError, ValueError):
+                    continue
+                digests = set()
+                for files in manifest["trees"].values():
+                    for _, digest, size in files:
+                        digests.add(digest)
+                        sizes[digest] = size
+                for digest in digests:
+                    refs[digest] = refs.get(digest, 0) + 1
+                entries.append((mtime, path, digests))
+
+            total = sum(sizes.values())
+            entries.sort()
+            # the newest entry stays even when it alone is over the cap
+            while total > self.max_size and len(entries) > 1:
+                _, path, digests = entries.pop(0)
+                os.remove(path)
+                for digest in digests:
+                    refs[digest] -= 1
+                    if not refs[digest]:
+                        try:
+                            os.remove(self._object(digest))
+                        except OSError:
+                            pass
+                        total -= sizes[digest]
+                logger.info("evicted %s from the artifact cache",
+                            os.path.basename(path)[:-len(".json")])
+            return total
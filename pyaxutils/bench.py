@@ -0,0 +1,351 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# `import pyaxutils.build` on top of the interpreter and logging, which every
+# entry point loads anyway
+STARTUP_MODULE = "%s.build" % os.path.basename(PACKAGE_DIR)
+STARTUP_LIMIT_MS = 10.0
+STARTUP_CODE = """
+import logging, sys, time
+before = set(sys.modules)
+start = time.time()
+import %s
+elapsed = time.time() - start
+sys.stdout.write("%%r %%s" %% (elapsed, " ".join(sorted(set(sys.modules) - before))))
+"""
+
+SIZES = dict(
+    small=dict(depth=2, width=4, targets=4),
+    medium=dict(depth=3, width=8, targets=16),
+    large=dict(depth=4, width=10, targets=64),
+)
+SIZE_ORDER = ["small", "medium", "large"]
+
+# toolchains only exist as settings here, nothing looks for vcvarsall
+PLATFORMS = ["win32", "win64"]
+TOOLCHAINS = ["msvc141", "msvc142"]
+CONFIGS = ["Debug", "Release"]
+
+THRESHOLD = 0.25
+MIN_TIME = 0.05
+
+
+def _import_build():
+    if __package__:
+        from . import build, utils
+    else:
+        import build
+        import utils
+    return build, utils
+
+
+def bench_startup(module=STARTUP_MODULE, repeat=20):
+    env = dict(os.environ)
+    # measure a warm start, with bytecode cached as installed code has it
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    samples = []
+    modules = []
+    for i in range(repeat + 1):
+        out = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_CODE % module],
+            cwd=os.path.dirname(PACKAGE_DIR),
+            env=env).decode("utf-8").split()
+        if i:
+            samples.append(float(out[0]) * 1000)
+        modules = out[1:]
+    samples.sort()
+    return dict(median=samples[len(samples) // 2],
+                min=samples[0],
+                max=samples[-1],
+                modules=modules)
+
+
+def make_tree(depth, width, tag=0):
+    if depth <= 0:
+        return "value-%d" % tag
+    tree = {}
+    for i in range(width):
+        key = "key%d" % i
+        if i % 4 == 3:
+            tree[key] = ["item-%d-%d" % (tag, x) for x in range(width)]
+        elif i % 4 == 2:
+            tree[key] = tag * width + i
+        else:
+            tree[key] = make_tree(depth - 1, width, tag * width + i)
+    return tree
+
+
+def make_settings(size):
+    targets = ["target%d" % i for i in range(size["targets"])]
+    toolchains = dict(
+        (name, dict(toolset="14.%d" % i,
+                    arch=dict(win32="x86", win64="x64"),
+                    extra=make_tree(size["depth"] - 1, size["width"], i)))
+        for i, name in enumerate(TOOLCHAINS))
+    return dict(src_dir="src",
+                buld_dir="build",
+                dist_dir="dist",
+                mingw_dir="mingw",
+                platforms=dict(default=PLATFORMS),
+                toolchains=dict(default=toolchains),
+                configs=CONFIGS,
+                targets=targets)
+
+
+def make_target_settings(i, size):
+    # sections keyed by alias and by full name, so lookups take both paths
+    config = dict((c, dict(defines=make_tree(size["depth"] - 1,
+                                             size["width"], i)))
+                  for c in CONFIGS)
+    depends = ["target%d" % x for x in set([i - 1, i // 2]) if 0 <= x < i]
+    return dict(depends=depends,
+                win=dict(msvc=config,
+                         msvc142=dict(config, configure="configure142")),
+                win64=dict(msvc141=config))
+
+
+def make_src_tree(top, size):
+    build, utils = _import_build()
+    for i in range(size["targets"]):
+        target_dir = utils.makedirs(top, "target%d" % i)
+        with open(os.path.join(target_dir,
+                               build.BUILD_SETTINGS_FILENAME), "w") as fd:
+            json.dump(make_target_settings(i, size), fd)
+    return top
+
+
+def _timeit(func):
+    # seconds per call, best of 5 runs of at least MIN_TIME each
+    timer = timeit.default_timer
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            func()
+        elapsed = timer() - start
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(4):
+        start = timer()
+        for _ in range(number):
+            func()
+        best = min(best, timer() - start)
+    return best / number
+
+
+def bench_merge(size, tmp):
+    build, utils = _import_build()
+    a = make_tree(size["depth"], size["width"], 1)
+    b = make_tree(size["depth"], size["width"], 2)
+    return _timeit(lambda: utils.merge({}, a, b))
+
+
+def bench_merged(size, tmp):
+    build, utils = _import_build()
+    a = make_tree(size["depth"], size["width"], 1)
+    b = make_tree(size["depth"], size["width"], 2)
+    return _timeit(lambda: utils.merged(a, b))
+
+
+def bench_transform(size, tmp):
+    build, utils = _import_build()
+    tree = make_tree(size["depth"], size["width"], 1)
+
+    def func(k, v):
+        return v
+
+    return _timeit(lambda: utils.transform(tree, func))
+
+
+def _json_file(size, tmp):
+    filename = os.path.join(tmp, "tree.json")
+    with open(filename, "w") as fd:
+        json.dump(make_tree(size["depth"], size["width"], 1), fd)
+    return filename
+
+
+def bench_load_json(size, tmp):
+    build, utils = _import_build()
+    filename = _json_file(size, tmp)
+    return _timeit(lambda: utils.load_json(filename))
+
+
+def bench_load_json_cold(size, tmp):
+    build, utils = _import_build()
+    filename = _json_file(size, tmp)
+
+    def load():
+        utils._json_cache.clear()
+        utils.load_json(filename)
+
+    return _timeit(load)
+
+
+def bench_settings(size, tmp):
+    build, utils = _import_build()
+    data = make_settings(size)
+    return _timeit(lambda: build.BuildSettings(data))
+
+
+def bench_get_by_alias(size, tmp):
+    build, utils = _import_build()
+    data = [make_target_settings(i, size) for i in range(size["targets"])]
+
+    def resolve():
+        for x in data:
+            for p in PLATFORMS:
+                y = build.get_by_alias(x, p, x)
+                for t in TOOLCHAINS:
+                    z = build.get_by_alias(y, t, y)
+                    for c in CONFIGS:
+                        build.get_by_alias(z, c, z)
+
+    return _timeit(resolve)
+
+
+def bench_matrix(size, tmp):
+    build, utils = _import_build()
+    settings = build.BuildSettings(make_settings(size))
+    src_dir = make_src_tree(os.path.join(tmp, "src"), size)
+
+    def expand():
+        args = argparse.Namespace(src_dir=src_dir,
+                                  platforms=settings.platforms,
+                                  toolchains=settings.toolchains.keys(),
+                                  configs=settings.configs,
+                                  targets=settings.targets[-1:])
+        build.Builder(args, settings).plan()
+
+    return _timeit(expand)
+
+
+BENCHMARKS = [
+    ("merge", bench_merge),
+    ("merged", bench_merged),
+    ("transform", bench_transform),
+    ("load_json", bench_load_json),
+    ("load_json_cold", bench_load_json_cold),
+    ("settings", bench_settings),
+    ("get_by_alias", bench_get_by_alias),
+    ("matrix", bench_matrix),
+]
+
+
+def run_benchmarks(names=None, sizes=SIZE_ORDER):
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for size in sizes:
+            tmp = tempfile.mkdtemp(prefix="pyaxutils-bench-")
+            try:
+                key = "%s/%s" % (name, size)
+                results[key] = func(SIZES[size], tmp)
+                logger.info("%-24s %10.1fus", key, results[key] * 1e6)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key] / baseline[key] if baseline[key] else 1.0
+        if ratio > 1.0 + threshold:
+            regressions.append((key, baseline[key], results[key], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks",
+                        help="benchmarks to run, all by default",
+                        nargs="*")
+    parser.add_argument("--size",
+                        help="synthetic settings tree sizes",
+                        action="append",
+                        dest="sizes",
+                        choices=SIZE_ORDER)
+    parser.add_argument("-r", "--repeat",
+                        help="fresh interpreters to time for startup",
+                        type=int,
+                        default=20)
+    parser.add_argument("--max-startup-ms",
+                        help="fail when the median import time is above this",
+                        type=float,
+                        default=STARTUP_LIMIT_MS)
+    parser.add_argument("-o", "--output",
+                        help="write the results as JSON to this file",
+                        default=None)
+    parser.add_argument("--baseline",
+                        help="compare against the results in this JSON file",
+                        default=None)
+    parser.add_argument("--threshold",
+                        help="allowed slowdown against the baseline, 0.25 "
+                        "fails anything more than 25%% slower",
+                        type=float,
+                        default=THRESHOLD)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    names = args.benchmarks
+    known = ["startup"] + [x for x, _ in BENCHMARKS]
+    for name in names:
+        if name not in known:
+            parser.error("unknown benchmark '%s', choose from %s"
+                         % (name, ", ".join(known)))
+
+    failed = False
+    results = {}
+    if not names or "startup" in names:
+        startup = bench_startup(repeat=args.repeat)
+        logger.info("import %s: median %.2fms (min %.2fms, max %.2fms), "
+                    "%d modules loaded", STARTUP_MODULE, startup["median"],
+                    startup["min"], startup["max"], len(startup["modules"]))
+        logger.debug("modules: %s", " ".join(startup["modules"]))
+        results["startup"] = startup["median"] / 1000
+        if startup["median"] > args.max_startup_ms:
+            logger.error("startup regression: %.2fms > %.2fms",
+                         startup["median"], args.max_startup_ms)
+            failed = True
+    if names != ["startup"]:
+        results.update(run_benchmarks([x for x in names if x != "startup"],
+                                      args.sizes or SIZE_ORDER))
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(dict(python=platform.python_version(),
+                           platform=sys.platform,
+                           results=results), fd, indent=1, sort_keys=True)
+        logger.info("results written to %s", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)["results"]
+        for key, old, new, ratio in compare(results, baseline,
+                                            args.threshold):
+            logger.error("%s regressed: %.1fus -> %.1fus (%+.0f%%)",
+                         key, old * 1e6, new * 1e6, (ratio - 1) * 100)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
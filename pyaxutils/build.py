@@ -1,13 +1,54 @@
-import subprocess
 import sys
 import logging
 import os
-import re
-import argparse
-import json
-
-import utils
-import msvc
+import collections
+import functools
+import importlib
+import threading
+
+
+class _LazyModule(object):
+    # sibling modules are imported on first use, so importing build stays
+    # cheap for callers that only want part of the API
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            if __package__:
+                self._module = importlib.import_module(
+                    "." + self._name, __package__)
+            else:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        # module settings such as utils.JSON_CACHE_DIR belong to the module
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._load(), name, value)
+
+
+aio = _LazyModule("aio")
+artifacts = _LazyModule("artifacts")
+common = _LazyModule("common")
+environ = _LazyModule("environ")
+fingerprint = _LazyModule("fingerprint")
+history = _LazyModule("history")
+jobserver = _LazyModule("jobserver")
+msvc = _LazyModule("msvc")
+report = _LazyModule("report")
+runner = _LazyModule("runner")
+scheduler = _LazyModule("scheduler")
+shell = _LazyModule("shell")
+stamp = _LazyModule("stamp")
+utils = _LazyModule("utils")
+watch = _LazyModule("watch")
 
 BUILD_SETTINGS_FILENAME = "build-settings.json"
 
@@ -20,16 +61,7 @@ ALIASES = {
 
 
 NEPHOS_DEBUG = int(os.environ.get("NEPHOS_DEBUG", 0))
-if not __package__:
-    logging.basicConfig()
-    logger = logging.getLogger()
-else:
-    logger = logging.getLogger(__package__.name)
-
-if NEPHOS_DEBUG:
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
+logger = logging.getLogger(__package__ or None)
 
 
 def get_by_alias(data, key, default=None):
@@ -43,63 +75,252 @@ def get_by_alias(data, key, default=None):
 ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
-class Settings:
+class _KeyTable(object):
+    # key -> slot index, shared by every Settings instance with the same keys
+    # in the same order; adding a key moves an instance to the next table
+    __slots__ = ("keys", "index", "_next", "__weakref__")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((k, i) for i, k in enumerate(keys))
+        self._next = {}
+
+    def add(self, key):
+        table = self._next.get(key)
+        if table is None:
+            table = self._next.setdefault(key, _KeyTable(self.keys + (key,)))
+        return table
+
+
+_EMPTY_KEYS = _KeyTable(())
+
+
+def _restore_settings(cls, keys, values):
+    obj = cls.__new__(cls)
+    obj._init(zip(keys, values))
+    return obj
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, Settings):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    return value
+
+
+class _ReadOnlyDict(dict):
+    # still a dict for json and isinstance checks, but any change raises
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("settings are read-only")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def _read_only(value):
+    # nested values of parsed json may be shared with the load_json cache
+    if isinstance(value, dict) and not isinstance(value, _ReadOnlyDict):
+        return _ReadOnlyDict((k, _read_only(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_read_only(x) for x in value)
+    return value
+
+
+class Settings(object):
+    __slots__ = ("_table", "_values")
+
     def __init__(self, **kwargs):
-        self._keys = []
-        for k, v in kwargs.iteritems():
-            self._keys.append(k)
-            setattr(self, k, v)
+        self._init(kwargs.items())
+
+    def _init(self, items):
+        object.__setattr__(self, "_table", _EMPTY_KEYS)
+        object.__setattr__(self, "_values", [])
+        for k, v in items:
+            self._set(k, v)
+
+    def _set(self, key, value):
+        i = self._table.index.get(key)
+        if i is None:
+            object.__setattr__(self, "_table", self._table.add(key))
+            self._values.append(value)
+        else:
+            self._values[i] = value
+        return self
 
     def keys(self):
-        return self._keys
+        return list(self._table.keys)
+
+    def items(self):
+        return list(zip(self._table.keys, self._values))
 
     def get(self, key, default=None):
-        if key in self._keys:
-            return getattr(self, key)
-        else:
+        i = self._table.index.get(key)
+        if i is None:
             return default
+        return self._values[i]
 
     def set(self, key, value):
-        if key not in self._keys:
-            self._keys.append(key)
-        setattr(self, key, value)
-        return self
+        return self._set(key, value)
 
     def merge(self, **src):
-        for k, v in src.iteritems():
+        for k, v in src.items():
             self.set(k, v)
         return self
 
     def __getitem__(self, key):
-        if key not in self._keys:
-            raise KeyError(key=key)
-        return self.get(key)
+        i = self._table.index.get(key)
+        if i is None:
+            raise KeyError(key)
+        return self._values[i]
 
     def __setitem__(self, k, v):
         self.set(k, v)
 
     def __contains__(self, k):
-        return k in self._keys
+        return k in self._table.index
+
+    def __iter__(self):
+        return iter(self._table.keys)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        i = self._table.index.get(name)
+        if i is None:
+            raise AttributeError(name)
+        return self._values[i]
+
+    def __setattr__(self, name, value):
+        self.set(name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, Settings):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (_restore_settings,
+                (self.__class__, self._table.keys, tuple(self._values)))
+
+    def __repr__(self):
+        return "<%s %s>" % (
+            self.__class__.__name__,
+            ", ".join("%s=%r" % x for x in self.items()))
 
 
 class BuildSettings(Settings):
+    __slots__ = ()
+
     def __init__(self, data):
         Settings.__init__(self, **data)
         self.platforms = utils.get_by_platform(**self.platforms)
         self.toolchains = Settings(
-            **utils.transform(
-                utils.get_by_platform(**self.toolchains),
-                lambda k, v: Settings(**v)
-            )
+            **dict((k, Settings(**v))
+                   for k, v in utils.get_by_platform(**self.toolchains).items())
         )
 
 
+class FrozenSettings(Settings):
+    __slots__ = ("_hash",)
+
+    def _init(self, items):
+        Settings._init(self, ((k, _read_only(v)) for k, v in items))
+
+    def set(self, key, value):
+        raise TypeError("settings are read-only")
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            h = hash(_freeze(self))
+            object.__setattr__(self, "_hash", h)
+            return h
+
+
+TARGET_DEFAULTS = dict(disable=False,
+                       configure="configure",
+                       build="build",
+                       install="install",
+                       shell=True)
+
+
+class TargetSettingsResolver:
+    def __init__(self, src_dir):
+        self.src_dir = src_dir
+        self._data = {}
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def load(self, target):
+        data = self._data.get(target)
+        if data is None:
+            data = utils.load_json(
+                os.path.join(utils.abspath(target, self.src_dir),
+                             BUILD_SETTINGS_FILENAME), {}, copy=False) or {}
+            with self._lock:
+                data = self._data.setdefault(target, data)
+        return data
+
+    def _resolve(self, target, platform, toolchain, config):
+        data = self.load(target)
+        data = get_by_alias(data, platform, data)
+        data = get_by_alias(data, toolchain, data)
+        data = get_by_alias(data, config, data)
+        # combinations resolving to the same section share one result
+        key = (target, id(data))
+        result = self._resolved.get(key)
+        if result is None:
+            values = dict(TARGET_DEFAULTS)
+            values.update(data)
+            result = FrozenSettings(**values)
+            with self._lock:
+                result = self._resolved.setdefault(key, result)
+        return result
+
+    def invalidate(self, target):
+        with self._lock:
+            self._data.pop(target, None)
+            for key in [k for k in self._resolved if k[0] == target]:
+                del self._resolved[key]
+
+    def resolve(self, target, platform, toolchain, config):
+        key = (target, platform, toolchain, config)
+        result = self._resolved.get(key)
+        if result is None:
+            result = self._resolve(target, platform, toolchain, config)
+            with self._lock:
+                self._resolved[key] = result
+        return result
+
+    def precompute(self, targets, platforms, toolchains, configs):
+        for target in targets:
+            for platform in platforms:
+                for toolchain in toolchains:
+                    for config in configs:
+                        self.resolve(target, platform, toolchain, config)
+
+
 class PlatformSetting:
     def __init__(self,
                  default=None,
                  **kwargs):
         self.default = default
-        for k, v in kwargs.iteritems():
+        for k, v in kwargs.items():
             setattr(self, k, v)
 
     def get(self):
@@ -216,7 +437,7 @@ class PlatformSetting:
 #     return " ".join([arg.strip().replace(" ", "\\ ") for arg in args])
 
 
-settings = dict(
+DEFAULT_SETTINGS = dict(
     src_dir=os.path.join(ROOT_DIR, "src"),
     buld_dir=os.path.join(ROOT_DIR, "build"),
     dist_dir=os.path.join(ROOT_DIR, "dist"),
@@ -241,36 +462,16 @@ settings = dict(
 
 )
 
-argv = sys.argv[1:]
-
-parser = argparse.ArgumentParser()
-parser.add_argument("-v", "--verbose",
-                    help="log level",
-                    action="count",
-                    default=0)
-args, argv = parser.parse_known_args(argv)
-if args.verbose > 0:
-    level = min(logging.INFO - args.verbose * 10, logging.NOTSET)
-    logger.setLevel(level=level)
-    logger.log(level, "log level=%s" % level)
-
-
-# parser = argparse.ArgumentParser()
-parser.add_argument("--settings-file",
-                    nargs="?",
-                    help="settings file",
-                    action="append",
-                    dest="settings")
-args, argv = parser.parse_known_args(argv)
-
-for cfg in [BUILD_SETTINGS_FILENAME] + (args.settings or[]):
-    cfg = os.path.join(ROOT_DIR, cfg)
-    if not os.path.isfile(cfg):
-        continue
-    with open(cfg) as fd:
-        cfg = json.load(fd)
-        fd.close()
-    utils.merge(settings, cfg)
+
+def load_settings(files=None, root_dir=ROOT_DIR):
+    layers = [DEFAULT_SETTINGS]
+    for cfg in [BUILD_SETTINGS_FILENAME] + list(files or []):
+        cfg = os.path.join(root_dir, cfg)
+        if not os.path.isfile(cfg):
+            continue
+        layers.append(utils.load_json(cfg, copy=False))
+    # the parsed files stay cached, merged() leaves them untouched
+    return BuildSettings(utils.merged(*layers))
 
 
 # def update_settings(data):
@@ -290,225 +491,893 @@ for cfg in [BUILD_SETTINGS_FILENAME] + (args.settings or[]):
 
 
 # utils.merge(settings, os.environ)
-settings = BuildSettings(settings)
-
-
-parser.add_argument("-s", "--src-dir",
-                    help="src dir",
-                    default=settings.src_dir)
-
-parser.add_argument("-b", "--build-dir",
-                    help="build dir",
-                    default=settings.buld_dir)
-
-parser.add_argument("-d", "--dist-dir",
-                    help="dist dir",
-                    default=settings.dist_dir)
-
-if sys.platform == "win32":
-    parser.add_argument("--mingw-dir",
-                        help="mingw dir",
-                        dest="mingw_dir",
-                        default=settings.mingw_dir)
-
-parser.add_argument("--sh",
-                    help="sh path",
-                    dest="sh_path",
-                    default=None)
-
-parser.add_argument("-p", "--platform",
-                    help="platform",
-                    action="append",
-                    dest="platforms",
-                    choices=settings.platforms)
-
-parser.add_argument("--toolchain",
-                    help="tool chain",
-                    action="append",
-                    dest="toolchains",
-                    choices=settings.toolchains.keys())
-
-parser.add_argument("-c", "--config",
-                    help="config type",
-                    action="append",
-                    dest="configs",
-                    choices=settings.configs)
-
-parser.add_argument("-t", "--target",
-                    nargs="?",
-                    help="build targets",
-                    action="append",
-                    dest="targets")
-
-parser.add_argument("--configure",
-                    action="store_true",
-                    help="configure targets",
-                    default=None)
-
-parser.add_argument("--build",
-                    action="store_true",
-                    help="build targets",
-                    default=None)
-
-parser.add_argument("--install",
-                    action="store_true",
-                    help="install targets",
-                    default=None)
-
-args = parser.parse_args(argv)
-logger.debug(args)
-
-
-if args.configure is None and args.build is None and args.install is None:
-    args.configure = True
-    args.build = True
-    args.install = True
-
-if args.sh_path is not None and not os.path.isfile(args.sh_path):
-    raise RuntimeError("sh not found(%s)!" % args.sh_path)
-
-if sys.platform == "win32":
-    if args.mingw_dir:
-        if not os.path.isdir(args.mingw_dir):
-            raise RuntimeError("mingw dir not found(%s)!" % args.mingw_dir)
-        if args.sh_path is None:
-            args.sh_path = os.path.join(
-                args.mingw_dir, "msys", "1.0", "bin", "sh.exe")
-
-logger.debug("mingw_dir=%s" % args.mingw_dir)
-
-if args.sh_path is None:
-    try:
-        subprocess.check_call(["sh", "--version"])
-        args.sh_path = "sh"
-    except subprocess.CalledProcessError:
-        pass
-    except WindowsError:
-        pass
-logger.debug("sh_path=%s" % args.sh_path)
-
-if not args.platforms:
-    args.platforms = settings.platforms
-
-if not args.toolchains:
-    args.toolchains = settings.toolchains.keys()
-
-
-if not args.configs:
-    args.configs = settings.configs
-
-if not args.targets:
-    args.targets = settings.targets
-
-logger.debug(args)
-
-for platform, toolchain, config, target in [
-    (platform, toolchain, config, target)
-    for platform in args.platforms
-    for toolchain in args.toolchains
-    for config in args.configs
-    for target in args.targets
-]:
-    if platform not in settings.platforms:
-        raise RuntimeError("unknown platform '%s'" % platform)
-    if toolchain not in settings.toolchains:
-        raise RuntimeError("unknown toolchain '%s'" % toolchain)
-    toolchain_settings = settings.toolchains[toolchain]
-
-    if config not in settings.configs:
-        raise RuntimeError("unknown config '%s'" % config)
-    if target not in settings.targets:
-        raise RuntimeError("unknown target '%s'" % target)
-
-    print platform, toolchain, config, target  # , args
-
-    os.environ["SH_PATH"] = args.sh_path or ""
-
-    src_dir = utils.abspath(target, args.src_dir)
-    logger.debug("SRC_DIR=%s", src_dir)
-    os.environ["SRC_DIR"] = src_dir
-
-    build_dir = utils.makedirs(args.build_dir,
-                               platform, toolchain, config, target)
-    logger.debug("BUILD_DIR=%s", build_dir)
-    os.environ["BUILD_DIR"] = build_dir
-
-    target_settings = utils.load_json(
-        os.path.join(src_dir, BUILD_SETTINGS_FILENAME), {})
-
-    target_settings = get_by_alias(target_settings, platform, target_settings)
-    target_settings = get_by_alias(target_settings, toolchain, target_settings)
-    target_settings = get_by_alias(target_settings, config, target_settings)
-    target_settings = Settings(disable=False,
-                               configure="configure",
-                               build="build",
-                               install="install",
-                               shell=True).merge(**target_settings)
-
-    if target_settings.disable:
-        logger.info("target '%s' for %s/%s/%s disabled.",
-                    target, platform, toolchain, config)
-        continue
-
-    if toolchain.startswith("msvc"):
-        arch = toolchain_settings.arch[platform]
-        toolchain_settings = msvc.get_msvc(
-            arch, toolset=toolchain_settings.toolset)
-        print toolchain_settings
+
+
+def setup_logging(verbose=0, rate=None):
+    # records are written by a background thread, workers never wait on
+    # stderr
+    common.setup(rate=rate)
+    if NEPHOS_DEBUG:
+        logger.setLevel(logging.DEBUG)
     else:
-        raise RuntimeError("unknown toolchian '%s'" % toolchain)
-
-    if args.configure:
-        logger.info("configuring...")
-        if target_settings.shell:
-            cmd = "%s && \"%s\" %s %s %s" % (
-                toolchain_settings.shell_setvars,
-                os.path.join(src_dir, target_settings.configure),
-                platform,
-                toolchain,
-                config)
-            subprocess.check_call(
-                cmd,
-                cwd=build_dir,
-                shell=True
-            )
+        logger.setLevel(logging.INFO)
+    if verbose > 0:
+        level = min(logging.INFO - verbose * 10, logging.NOTSET)
+        logger.setLevel(level=level)
+        logger.log(level, "log level=%s" % level)
+
+
+def add_common_arguments(parser):
+    parser.add_argument("-v", "--verbose",
+                        help="log level",
+                        action="count",
+                        default=0)
+
+    parser.add_argument("--settings-file",
+                        nargs="?",
+                        help="settings file",
+                        action="append",
+                        dest="settings")
+
+    parser.add_argument("--log-rate",
+                        help="at most this many info/debug messages a second "
+                        "per logger, the rest are counted and dropped",
+                        type=float,
+                        default=None)
+
+    parser.add_argument("--json-cache",
+                        help="keep parsed settings files in this directory",
+                        default=None)
+
+
+def add_build_arguments(parser, settings):
+    parser.add_argument("-s", "--src-dir",
+                        help="src dir",
+                        default=settings.src_dir)
+
+    parser.add_argument("-b", "--build-dir",
+                        help="build dir",
+                        default=settings.buld_dir)
+
+    parser.add_argument("-d", "--dist-dir",
+                        help="dist dir",
+                        default=settings.dist_dir)
+
+    if sys.platform == "win32":
+        parser.add_argument("--mingw-dir",
+                            help="mingw dir",
+                            dest="mingw_dir",
+                            default=settings.mingw_dir)
+
+    parser.add_argument("--sh",
+                        help="sh path",
+                        dest="sh_path",
+                        default=None)
+
+    parser.add_argument("-p", "--platform",
+                        help="platform",
+                        action="append",
+                        dest="platforms",
+                        choices=settings.platforms)
+
+    parser.add_argument("--toolchain",
+                        help="tool chain",
+                        action="append",
+                        dest="toolchains",
+                        choices=settings.toolchains.keys())
+
+    parser.add_argument("-c", "--config",
+                        help="config type",
+                        action="append",
+                        dest="configs",
+                        choices=settings.configs)
+
+    parser.add_argument("-t", "--target",
+                        nargs="?",
+                        help="build targets",
+                        action="append",
+                        dest="targets")
+
+    parser.add_argument("--configure",
+                        action="store_true",
+                        help="configure targets",
+                        default=None)
+
+    parser.add_argument("--build",
+                        action="store_true",
+                        help="build targets",
+                        default=None)
+
+    parser.add_argument("--install",
+                        action="store_true",
+                        help="install targets",
+                        default=None)
+
+    parser.add_argument("--step-output",
+                        help="'stream' echoes step output as it comes, "
+                        "'on-failure' only shows the end of the step log when "
+                        "a step fails; the default is 'stream' on a terminal "
+                        "and 'on-failure' otherwise",
+                        choices=["stream", "on-failure"])
+
+    parser.add_argument("--tail-lines",
+                        help="number of log lines kept for failed steps",
+                        type=int,
+                        default=runner.TAIL_LINES)
+
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="ignore build stamps and rerun every step",
+                        default=False)
+
+    parser.add_argument("--report",
+                        help="write a JSON timing report of the run to this "
+                        "file",
+                        default=None)
+
+    parser.add_argument("--trace",
+                        help="write a Chrome trace-event file of the run",
+                        default=None)
+
+    parser.add_argument("-j", "--jobs",
+                        help="number of cells to build in parallel",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--engine",
+                        help="'threads' runs cells on a thread pool "
+                        "(sequential with -j1), 'asyncio' drives every step "
+                        "from a single event loop (python 3 only)",
+                        choices=["threads", "asyncio"],
+                        default="threads")
+
+    parser.add_argument("-k", "--keep-going",
+                        action="store_true",
+                        help="keep building other cells after a failure",
+                        default=False)
+
+    parser.add_argument("--artifact-cache",
+                        help="restore unchanged cells from, and store built "
+                        "cells in, this directory",
+                        default=None)
+
+    parser.add_argument("--artifact-cache-size",
+                        help="artifact cache size limit in MiB, least "
+                        "recently used cells are evicted first",
+                        type=int,
+                        default=10 * 1024)
+
+    parser.add_argument("--plan", "--dry-run",
+                        help="print the steps a build would run, in order, "
+                        "without running them or creating build dirs",
+                        nargs="?",
+                        choices=["text", "json"],
+                        const="text",
+                        dest="plan",
+                        default=None)
+
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="keep running and rebuild the cells whose "
+                        "sources or build settings change",
+                        default=False)
+
+    parser.add_argument("--no-jobserver",
+                        action="store_false",
+                        help="do not share the -j budget with child makes "
+                        "through a GNU make jobserver",
+                        dest="jobserver",
+                        default=True)
+
+    parser.add_argument("--history-file",
+                        help="SQLite file step results are recorded in, "
+                        "used to order cells and estimate the time left "
+                        "(default: <build dir>/%s)" % history.HISTORY_FILENAME,
+                        default=None)
+
+    parser.add_argument("--history",
+                        action="store_true",
+                        help="print the slowest and flakiest targets from "
+                        "the build history and exit",
+                        default=False)
+
+
+def finish_args(args, settings):
+    if args.configure is None and args.build is None and args.install is None:
+        args.configure = True
+        args.build = True
+        args.install = True
+
+    if args.sh_path is not None and not os.path.isfile(args.sh_path):
+        raise RuntimeError("sh not found(%s)!" % args.sh_path)
+
+    mingw_dir = None
+    if sys.platform == "win32":
+        if args.mingw_dir:
+            if not os.path.isdir(args.mingw_dir):
+                raise RuntimeError("mingw dir not found(%s)!" % args.mingw_dir)
+            mingw_dir = args.mingw_dir
+        logger.debug("mingw_dir=%s" % args.mingw_dir)
+
+    sh = shell.find_sh(args.sh_path, mingw_dir, cache_file=shell.CACHE_FILE)
+    args.sh_path = sh and sh.path
+    logger.debug("sh_path=%s" % args.sh_path)
+
+    if args.step_output is None:
+        # keeps ci logs down to the steps that failed
+        args.step_output = "stream" if sys.stdout.isatty() else "on-failure"
+
+    if args.history_file is None:
+        args.history_file = os.path.join(args.build_dir,
+                                         history.HISTORY_FILENAME)
+
+    if not args.platforms:
+        args.platforms = settings.platforms
+
+    if not args.toolchains:
+        args.toolchains = settings.toolchains.keys()
+
+    if not args.configs:
+        args.configs = settings.configs
+
+    if not args.targets:
+        args.targets = settings.targets
+
+    logger.debug(args)
+    return args
+
+
+def parse_args(argv=None, recorder=None):
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    add_common_arguments(parser)
+    args, _ = parser.parse_known_args(argv)
+    setup_logging(args.verbose, args.log_rate)
+
+    utils.JSON_CACHE_DIR = args.json_cache
+
+    if recorder is None:
+        settings = load_settings(args.settings)
+    else:
+        with recorder.phase("settings"):
+            settings = load_settings(args.settings)
+
+    add_build_arguments(parser, settings)
+    args = parser.parse_args(argv)
+    logger.debug(args)
+    return finish_args(args, settings), settings
+
+
+class Cell(collections.namedtuple("Cell",
+                                  "platform toolchain config target")):
+    def __str__(self):
+        return "/".join(self)
+
+
+_output_lock = threading.Lock()
+
+
+def output(cell, line):
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    with _output_lock:
+        out.write(("[%s] " % (cell,)).encode("utf-8") + line)
+        out.flush()
+
+
+class CellLogger(logging.LoggerAdapter):
+    # prefixes messages with their cell and tags the records for the
+    # handlers of common.add_cell_handler
+    def __init__(self, logger, cell):
+        logging.LoggerAdapter.__init__(self, logger, dict(cell=cell))
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = self.extra
+        return "[%s] %s" % (self.extra["cell"], msg), kwargs
+
+
+class Step(collections.namedtuple("Step",
+                                  "cell name cmd cwd env stamps fingerprint "
+                                  "invalidates")):
+    def __str__(self):
+        return "%s:%s" % (self.cell, self.name)
+
+
+class Builder(object):
+    def __init__(self, args, settings, recorder=None):
+        self.args = args
+        self.settings = settings
+        self.recorder = recorder or report.Recorder()
+        self.resolver = TargetSettingsResolver(args.src_dir)
+        self.cells = []
+        self.cell_deps = {}
+        self.uncaptured = set()
+        self.loggers = {}
+        self.artifacts = None
+        if getattr(args, "artifact_cache", None):
+            self.artifacts = artifacts.ArtifactCache(
+                args.artifact_cache, args.artifact_cache_size * 1024 ** 2)
+        self._artifact_keys = {}
+        # a build or dist dir inside a source tree is not a source
+        self.fingerprinter = fingerprint.Fingerprinter(
+            ignore=settings.get("fingerprint_ignore") or
+            fingerprint.IGNORE_PATTERNS,
+            exclude=[x for x in (getattr(args, "build_dir", None),
+                                 getattr(args, "dist_dir", None)) if x])
+        self._fingerprints = {}
+        self._source_hashes = {}
+        # every step environment is a layer over this one snapshot
+        self.environ = environ.Environ()
+        self._toolchain_environs = {}
+        self.history = history.History(
+            getattr(args, "history_file", None))
+        self.progress = None
+        self.jobserver = None
+        # the requested targets, plan() adds their dependencies
+        self.targets = list(args.targets or ())
+        self.watcher = None
+        self._watched = {}
+        self._changed = {}
+
+    def step_output(self, step):
+        if self.args.step_output == "stream":
+            return lambda line: output(step.cell, line)
+        return None
+
+    def start_step(self, step):
+        self.loggers[step.cell].info("%s...", step.name)
+        for name in step.invalidates:
+            step.stamps.invalidate(name)
+
+    def finish_step(self, step, result):
+        step.stamps.update(step.name, step.fingerprint)
+        self.history.record(step.cell, step.name, result.elapsed,
+                            result.returncode, step.fingerprint)
+        log = self.loggers[step.cell]
+        log.info("%s finished in %.1fs", step.name, result.elapsed)
+        if step.name == "build" and step.cell in self._artifact_keys:
+            key, trees = self._artifact_keys.pop(step.cell)
+            with self.recorder.phase("store-artifacts", step.cell):
+                try:
+                    # stamps and step logs belong to this run only
+                    self.artifacts.store(key, trees, (stamp.STAMP_FILENAME,
+                                                      "configure.log",
+                                                      "build.log"))
+                except (IOError, OSError) as e:
+                    log.warning("cannot store artifacts: %s", e)
+
+    def fail_step(self, step, result):
+        self.history.record(step.cell, step.name, result.elapsed,
+                            result.returncode, step.fingerprint)
+        if self.args.step_output == "on-failure":
+            for line in result.tail:
+                output(step.cell, line)
+        self.loggers[step.cell].error(
+            "%s failed with exit code %d after %.1fs, see %s",
+            step.name, result.returncode, result.elapsed, result.log_file)
+
+    def run_step(self, step):
+        with self.recorder.phase(step.name, step.cell):
+            self.start_step(step)
+            try:
+                result = runner.run(step.cmd,
+                                    cwd=step.cwd,
+                                    env=step.env,
+                                    log_file=os.path.join(
+                                        step.cwd, "%s.log" % step.name),
+                                    on_line=self.step_output(step),
+                                    tail_lines=self.args.tail_lines,
+                                    pass_fds=self.jobserver.fds
+                                    if self.jobserver is not None else ())
+            except runner.StepFailed as e:
+                self.fail_step(step, e.result)
+                raise
+            self.finish_step(step, result)
+            return result
+
+    def build_cell(self, cell):
+        with self.recorder.cell(cell):
+            failed = True
+            try:
+                for step in self.prepare_cell(cell):
+                    self.run_step(step)
+                self.loggers[cell].info("done")
+                failed = False
+            finally:
+                self.finish_cell(cell, failed)
+
+    def finish_cell(self, cell, failed=False):
+        if self.progress is not None:
+            self.progress.finish(cell, failed)
+
+    def prepare_cell(self, cell, dry_run=False):
+        args = self.args
+        recorder = self.recorder
+        platform, toolchain, config, target = cell
+        toolchain_settings = self.settings.toolchains[toolchain]
+
+        log = self.loggers[cell] = CellLogger(logger, cell)
+        log.info("start")
+        if self.progress is not None and not dry_run:
+            self.progress.start(cell)
+
+        env = self.environ
+        cell_env = dict(SH_PATH=args.sh_path or "")
+        if self.jobserver is not None:
+            cell_env.update(self.jobserver.environ)
+        elif dry_run and args.jobserver:
+            cell_env.update(jobserver.plan_environ(args.jobs, self.environ))
+
+        src_dir = utils.abspath(target, args.src_dir)
+        log.debug("SRC_DIR=%s", src_dir)
+        cell_env["SRC_DIR"] = src_dir
+
+        if dry_run:
+            build_dir = os.path.join(args.build_dir,
+                                     platform, toolchain, config, target)
         else:
+            build_dir = utils.makedirs(args.build_dir,
+                                       platform, toolchain, config, target)
+        log.debug("BUILD_DIR=%s", build_dir)
+        cell_env["BUILD_DIR"] = build_dir
+
+        dist_dir = os.path.join(args.dist_dir,
+                                platform, toolchain, config, target)
+        cell_env["DIST_DIR"] = dist_dir
+
+        with recorder.phase("target-settings", cell):
+            target_settings = self.resolver.resolve(
+                target, platform, toolchain, config)
+
+        if target_settings.disable:
+            log.info("disabled.")
+            recorder.set_status(cell, "disabled")
+            return []
+
+        if not target_settings.shell:
             raise RuntimeError("must shell=1")
 
-    if args.build:
-        logger.info("building...")
-        if target_settings.shell:
-            cmd = "%s && \"%s\" %s %s %s" % (
-                toolchain_settings.shell_setvars,
-                os.path.join(src_dir, target_settings.build),
-                platform,
-                toolchain,
-                config)
-            subprocess.check_call(
-                cmd,
-                cwd=build_dir,
-                shell=True
+        with recorder.phase("toolchain", cell):
+            if toolchain.startswith("msvc"):
+                arch = utils.get_path(toolchain_settings, ("arch", platform))
+                if arch is None:
+                    raise RuntimeError("toolchain '%s' has no arch for '%s'"
+                                       % (toolchain, platform))
+                toolchain_settings = msvc.get_msvc(
+                    arch, toolset=toolchain_settings.toolset,
+                    min_version=toolchain_settings.get("min_version"),
+                    max_version=toolchain_settings.get("max_version"),
+                    prefer=toolchain_settings.get("prefer"),
+                    cache_file=msvc.DISCOVERY_CACHE_FILE)
+                log.info("%s", toolchain_settings)
+                toolchain_env = self.toolchain_environ(toolchain_settings,
+                                                       dry_run)
+                if toolchain_env is None:
+                    # only a real run may start vcvarsall
+                    log.warning("toolchain environment not captured yet, "
+                                "planning with the base environment")
+                    self.uncaptured.add(cell)
+                else:
+                    env = toolchain_env
+            else:
+                raise RuntimeError("unknown toolchian '%s'" % toolchain)
+        env = env.layer(cell_env)
+
+        with recorder.phase("fingerprint", cell):
+            stamps = stamp.Stamps(build_dir)
+            # sources do not change while planning, nor while watching
+            # until the watcher says so; each tree is then hashed once
+            memo = dry_run or self.watcher is not None
+            sources = self._source_hashes.get(src_dir) if memo else None
+            if sources is None:
+                sources = self.fingerprinter.fingerprint(
+                    src_dir, self._changed.get(src_dir))
+                if memo:
+                    self._source_hashes[src_dir] = sources
+                    self._changed.pop(src_dir, None)
+            inputs = dict(
+                cell=list(cell),
+                sources=sources,
+                settings=dict((k, target_settings.get(k))
+                              for k in target_settings.keys()),
+                toolchain=toolchain_settings.shell_setvars,
+                # rebuild when a dependency was rebuilt
+                depends=[self.dep_stamp(dep, dry_run)
+                         for dep in self.cell_deps.get(cell, ())],
             )
-        else:
-            raise RuntimeError("must shell=1")
+            configure_fingerprint = stamp.hash_value(
+                dict(inputs, step="configure"))
+            build_fingerprint = stamp.hash_value(
+                dict(inputs, step="build", configure=configure_fingerprint))
+            if args.build:
+                # the build stamp this cell leaves behind once it has run
+                self._fingerprints[cell] = build_fingerprint
+
+        def make_step(name, fingerprint, invalidates):
+            return Step(cell=cell,
+                        name=name,
+                        cmd="\"%s\" %s %s %s" % (
+                            os.path.join(src_dir, target_settings.get(name)),
+                            platform,
+                            toolchain,
+                            config),
+                        cwd=build_dir,
+                        env=env,
+                        stamps=stamps,
+                        fingerprint=fingerprint,
+                        invalidates=invalidates)
+
+        steps = []
+        if args.configure:
+            if not args.force and stamps.is_fresh("configure",
+                                                  configure_fingerprint):
+                log.info("configure is up to date.")
+            else:
+                steps.append(make_step("configure", configure_fingerprint,
+                                       ("configure", "build")))
+
+        if args.build:
+            if not args.force and not steps and \
+                    stamps.is_fresh("build", build_fingerprint):
+                log.info("build is up to date.")
+            else:
+                steps.append(make_step("build", build_fingerprint,
+                                       ("build",)))
+
+        # if args.install:
+        #     if target_settings.shell:
+        #         cmd = "%s && \"%s\" %s %s %s" % (
+        #             toolchain_settings.shell_setvars,
+        #             os.path.join(src_dir, target_settings.install),
+        #             platform,
+        #             toolchain,
+        #             config)
+        #         subprocess.check_call(
+        #             cmd,
+        #             cwd=build_dir,
+        #             shell=True
+        #         )
+        #     else:
+        #         raise RuntimeError("must shell=1")
+
+        if steps and args.build and self.artifacts is not None:
+            key = stamp.hash_value(dict(inputs, step="artifacts"))
+            trees = dict(build=build_dir, dist=dist_dir)
+            if args.force:
+                cached = False
+            elif dry_run:
+                cached = self.artifacts.has(key)
+            else:
+                with recorder.phase("restore-artifacts", cell):
+                    cached = self.artifacts.restore(key, trees)
+                if cached:
+                    stamps.update("configure", configure_fingerprint)
+                    stamps.update("build", build_fingerprint)
+            if cached:
+                log.info("restored from the artifact cache.")
+                recorder.set_status(cell, "cached")
+                return []
+            if not dry_run:
+                self._artifact_keys[cell] = (key, trees)
+
+        if steps and not dry_run:
+            # files restored from the artifact cache may still be hardlinks
+            # into it, even when this run does not use the cache
+            for top in (build_dir, dist_dir):
+                artifacts.unshare(top)
+
+        if not steps:
+            recorder.set_status(cell, "up-to-date")
+        return steps
+
+    def toolchain_environ(self, toolchain, dry_run=False):
+        # cells on the same toolchain share one environment layer
+        key = toolchain.shell_setvars
+        env = self._toolchain_environs.get(key)
+        if env is None:
+            env = toolchain.environ(self.environ, capture=not dry_run)
+            if env is not None:
+                env = self._toolchain_environs.setdefault(key, env)
+        return env
+
+    def dep_stamp(self, dep, dry_run=False):
+        # a dry run has not built the dependency yet, so use the stamp it
+        # would leave rather than the one on disk
+        if dry_run and dep in self._fingerprints:
+            return self._fingerprints[dep]
+        return stamp.Stamps(os.path.join(self.args.build_dir, *dep)) \
+            .stamps.get("build")
+
+    def target_depends(self, target):
+        return list(self.resolver.load(target).get("depends", []))
+
+    def expand_targets(self, targets):
+        # requested targets plus everything they depend on, dependencies
+        # first; cycles are left in place for the scheduler to report
+        depends = {}
+        result = []
+        stack = [(target, None, False) for target in reversed(targets)]
+        while stack:
+            target, parent, expanded = stack.pop()
+            if expanded:
+                result.append(target)
+                continue
+            if target in depends:
+                continue
+            if target not in self.settings.targets:
+                if parent is None:
+                    raise RuntimeError("unknown target '%s'" % target)
+                raise RuntimeError(
+                    "unknown target '%s' (a dependency of '%s')"
+                    % (target, parent))
+            depends[target] = self.target_depends(target)
+            stack.append((target, parent, True))
+            stack += [(dep, target, False)
+                      for dep in reversed(depends[target])]
+        return result, depends
+
+    def plan(self):
+        args = self.args
+        settings = self.settings
+        for platform in args.platforms:
+            if platform not in settings.platforms:
+                raise RuntimeError("unknown platform '%s'" % platform)
+        for toolchain in args.toolchains:
+            if toolchain not in settings.toolchains:
+                raise RuntimeError("unknown toolchain '%s'" % toolchain)
+        for config in args.configs:
+            if config not in settings.configs:
+                raise RuntimeError("unknown config '%s'" % config)
+
+        args.targets, target_deps = self.expand_targets(self.targets)
+
+        self.cells = [
+            Cell(platform, toolchain, config, target)
+            for platform in args.platforms
+            for toolchain in args.toolchains
+            for config in args.configs
+            for target in args.targets
+        ]
+        self.cell_deps = dict(
+            (cell, [cell._replace(target=dep)
+                    for dep in target_deps[cell.target]])
+            for cell in self.cells)
+
+        scheduler.toposort(self.cells, self.cell_deps)
+
+        with self.recorder.phase("target-settings"):
+            self.resolver.precompute(args.targets,
+                                     args.platforms,
+                                     args.toolchains,
+                                     args.configs)
+        return self.cells
+
+    def plan_steps(self):
+        plan = []
+        for cell in scheduler.toposort(self.cells, self.cell_deps):
+            with self.recorder.cell(cell):
+                steps = self.prepare_cell(cell, dry_run=True)
+                if steps:
+                    self.recorder.set_status(cell, "planned")
+            plan.append(dict(
+                cell=str(cell),
+                depends=[str(x) for x in self.cell_deps.get(cell, ())],
+                status=self.recorder.cells[str(cell)]["status"],
+                environ_captured=cell not in self.uncaptured,
+                steps=[dict(name=step.name,
+                            cmd=step.cmd,
+                            cwd=step.cwd,
+                            env=dict(step.env),
+                            fingerprint=step.fingerprint)
+                       for step in steps]))
+        return plan
+
+    def run(self, cells=None):
+        args = self.args
+        cells = self.cells if cells is None else cells
+        with self.recorder.phase("history"):
+            durations = self.history.durations()
+        # cells without history are assumed to take the average
+        known = [durations[str(x)] for x in cells if str(x) in durations]
+        default = sum(known) / len(known) if known else 0.0
+        priority = scheduler.Graph(cells, self.cell_deps) \
+            .critical_weights(dict((x, durations[str(x)]) for x in cells
+                                   if str(x) in durations), default)
+        num_workers = args.jobs
+        if args.jobserver:
+            if self.jobserver is None:
+                # kept for every run of this builder, --watch included
+                self.jobserver = jobserver.setup(args.jobs, self.environ)
+            num_workers = self.jobserver.max_workers(args.jobs, len(cells))
+        self.progress = history.Progress(cells, durations, num_workers)
+        try:
+            with self.recorder.phase("build"):
+                if args.engine == "asyncio":
+                    cell_runner = aio.CellRunner(self.prepare_cell,
+                                                 self.start_step,
+                                                 self.finish_step,
+                                                 self.fail_step,
+                                                 self.step_output,
+                                                 self.recorder,
+                                                 args.tail_lines,
+                                                 self.finish_cell,
+                                                 self.jobserver)
+                    try:
+                        aio.run_jobs(cells, cell_runner,
+                                     num_workers=num_workers,
+                                     keep_going=args.keep_going,
+                                     depends=self.cell_deps,
+                                     priority=priority)
+                    finally:
+                        cell_runner.close()
+                else:
+                    func = self.build_cell
+                    if self.jobserver is not None:
+                        func = functools.partial(self.jobserver.run, func)
+                    scheduler.run_jobs(cells, func,
+                                       num_workers=num_workers,
+                                       keep_going=args.keep_going,
+                                       depends=self.cell_deps,
+                                       priority=priority)
+        except scheduler.JobsFailed as e:
+            # the run report lists the cells a failure kept from running
+            for cell in e.blocked:
+                self.recorder.set_status(cell, "skipped")
+            raise
+
+    def close(self):
+        if self.jobserver is not None:
+            self.jobserver.close()
+            self.jobserver = None
+
+    def start_watching(self):
+        # before the first build, so edits made while it runs are seen too
+        args = self.args
+        self._watched = {}
+        for target in args.targets:
+            self._watched.setdefault(
+                utils.abspath(target, args.src_dir), []).append(target)
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = watch.watcher(
+            sorted(self._watched), self.fingerprinter.ignore,
+            exclude=[utils.abspath(args.build_dir),
+                     utils.abspath(args.dist_dir)])
+
+    def changed_cells(self, changes):
+        # cells to rebuild for watcher changes: those of the changed targets
+        # and everything downstream of them
+        targets = set()
+        for top, paths in changes.items():
+            # dropping the hash makes the next prepare_cell rescan the tree,
+            # only at these paths if they are known
+            self._source_hashes.pop(top, None)
+            if paths is None or top not in self._changed:
+                self._changed[top] = paths
+            elif self._changed[top] is not None:
+                self._changed[top] |= paths
+            targets.update(self._watched.get(top, ()))
+
+        depends = dict((x, self.target_depends(x)) for x in targets)
+        for target in targets:
+            self.resolver.invalidate(target)
+        if any(self.target_depends(x) != depends[x] for x in targets):
+            logger.info("dependencies changed, planning again")
+            self.plan()
+            if set(utils.abspath(x, self.args.src_dir)
+                   for x in self.args.targets) != set(self._watched):
+                self.start_watching()
+
+        graph = scheduler.Graph(self.cells, self.cell_deps)
+        cells = set(x for x in self.cells if x.target in targets)
+        for cell in list(cells):
+            cells.update(graph.downstream(cell))
+        return [x for x in self.cells if x in cells]
+
+    def watch(self):
+        logger.info("watching %d source trees, Ctrl+C to stop",
+                    len(self._watched))
+        try:
+            while True:
+                changes = self.watcher.wait()
+                try:
+                    cells = self.changed_cells(changes)
+                except (RuntimeError, ValueError) as e:
+                    # a broken or half-written build-settings.json
+                    logger.error("%s", e)
+                    continue
+                if not cells:
+                    continue
+                logger.info("%d cells to rebuild", len(cells))
+                try:
+                    self.run(cells)
+                except scheduler.JobsFailed as e:
+                    logger.error("%s", e)
+                finally:
+                    self.history.flush()
+                    self.write_reports()
+        except KeyboardInterrupt:
+            logger.info("stopped watching")
+        finally:
+            self.watcher.close()
+            self.watcher = None
+        return 0
+
+    def write_reports(self):
+        if self.args.report:
+            self.recorder.write_json(
+                self.args.report,
+                dict((str(k), [str(x) for x in v])
+                     for k, v in self.cell_deps.items()))
+        if self.args.trace:
+            self.recorder.write_trace(self.args.trace)
+
+
+def write_plan(plan, fmt="text", out=None):
+    out = out or sys.stdout
+    if fmt == "json":
+        import json
+        json.dump(plan, out, indent=1, sort_keys=True)
+        out.write("\n")
+        return
+    base = os.environ
+    for cell in plan:
+        out.write("%s: %s\n" % (cell["cell"], cell["status"]))
+        for step in cell["steps"]:
+            out.write("  %s\n" % step["name"])
+            out.write("    cwd: %s\n" % step["cwd"])
+            out.write("    cmd: %s\n" % step["cmd"])
+            # only what differs from this process' environment
+            for k in sorted(step["env"]):
+                if base.get(k) != step["env"][k]:
+                    out.write("    env: %s=%s\n" % (k, step["env"][k]))
+            for k in sorted(base):
+                if k not in step["env"]:
+                    out.write("    env: -%s\n" % k)
+        if not cell["environ_captured"]:
+            out.write("  (toolchain environment not captured yet)\n")
+
+
+def main(argv=None):
+    recorder = report.Recorder()
+    args, settings = parse_args(argv, recorder)
+    builder = Builder(args, settings, recorder)
+
+    if args.history:
+        builder.history.write_report(sys.stdout)
+        return 0
+
+    try:
+        builder.plan()
+    except scheduler.DependencyCycle as e:
+        logger.error("%s", e)
+        return 1
+
+    if args.plan:
+        write_plan(builder.plan_steps(), args.plan)
+        return 0
+
+    if args.watch:
+        builder.start_watching()
+
+    try:
+        try:
+            builder.run()
+        except scheduler.JobsFailed as e:
+            logger.error("%s", e)
+            if not args.watch:
+                return 1
+        finally:
+            # one transaction for the whole run
+            builder.history.flush()
+            builder.write_reports()
+
+        if args.watch:
+            return builder.watch()
+        return 0
+    finally:
+        builder.close()
 
-    # if args.install:
-    #     if target_settings.shell:
-    #         cmd = "%s && \"%s\" %s %s %s" % (
-    #             toolchain_settings.shell_setvars,
-    #             os.path.join(src_dir, target_settings.install),
-    #             platform,
-    #             toolchain,
-    #             config)
-    #         subprocess.check_call(
-    #             cmd,
-    #             cwd=build_dir,
-    #             shell=True
-    #         )
-    #     else:
-    #         raise RuntimeError("must shell=1")
-
-    #assert 0
 
 # def get_build_targets(targets=[], args=args):
 #   targets = targets or args.target
@@ -533,3 +1402,7 @@ for platform, toolchain, config, target in [
 #     k = key_prefix + k
 #     d[k] = v
 #   return d
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,182 @@
-import logging
-logging.basicConfig()
-logger = logging.getLogger(__package__ and __package__.name or "")
-
-
-def debug(*args, **kwargs):
-    logger.debug(*args, **kwargs)
-
-
-def info(msg, *args, **kwargs):
-    logger.info(msg, *args, **kwargs)
-
-
-def warning(msg, *args, **kwargs):
-    logger.warning(msg, *args, **kwargs)
-
-
-def error(msg, *args, **kwargs):
-    logger.error(msg, *args, **kwargs)
-
-
-def exception(msg, *args, **kwargs):
-    logger.exception(msg, *args, **kwargs)
-
-
-def critical(msg, *args, **kwargs):
-    logger.critical(msg, *args, **kwargs)
-
-
-def log(level, msg, *args, **kwargs):
-    logger.log(level, msg, *args, **kwargs)
+import atexit
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__package__ or "")
+
+# bound straight to the logger, so a disabled level costs one level check
+# and no extra call layer
+debug = logger.debug
+info = logger.info
+warning = logger.warning
+error = logger.error
+exception = logger.exception
+critical = logger.critical
+log = logger.log
+# for callers whose arguments are expensive to build
+enabled = logger.isEnabledFor
+
+_STOP = object()
+
+
+class QueueHandler(logging.Handler):
+    # hands records to a QueueListener; the queue is unbounded, so emitting
+    # never blocks the calling thread on a slow stream or file
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # merge args now, they may change or go away once this thread moves
+        # on; exc_info is rendered for the same reason
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener:
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = list(handlers)
+        self.cell_handlers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add_handler(self, handler, cell=None):
+        # cell handlers only see records logged with extra={"cell": cell}
+        with self._lock:
+            if cell is None:
+                self.handlers = self.handlers + [handler]
+            else:
+                handlers = self.cell_handlers.get(str(cell), [])
+                self.cell_handlers[str(cell)] = handlers + [handler]
+
+    def remove_handler(self, handler, cell=None):
+        with self._lock:
+            if cell is None:
+                self.handlers = [x for x in self.handlers if x is not handler]
+            else:
+                handlers = [x for x in self.cell_handlers.get(str(cell), ())
+                            if x is not handler]
+                if handlers:
+                    self.cell_handlers[str(cell)] = handlers
+                else:
+                    self.cell_handlers.pop(str(cell), None)
+
+    def handle(self, record):
+        handlers = self.handlers
+        cell = getattr(record, "cell", None)
+        if cell is not None:
+            handlers = handlers + self.cell_handlers.get(str(cell), [])
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            self.handle(record)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor,
+                                        name="log-listener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # handles whatever is still queued, then returns
+        if self._thread is not None:
+            self.queue.put_nowait(_STOP)
+            self._thread.join()
+            self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+class RateLimitFilter(logging.Filter):
+    # token bucket per logger name: `rate` records a second on average,
+    # bursts of up to `burst`; dropped records are counted and reported on
+    # the next one that gets through
+    def __init__(self, rate, burst=None):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.time()
+        with self._lock:
+            tokens, last, dropped = self._buckets.get(
+                record.name, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now, dropped + 1)
+                return False
+            self._buckets[record.name] = (tokens - 1, now, 0)
+        if dropped:
+            record.msg = "%s (%d earlier messages suppressed)" % (
+                record.getMessage(), dropped)
+            record.args = None
+        return True
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def setup(level=None, handlers=None, fmt=logging.BASIC_FORMAT, rate=None,
+          burst=None):
+    # replaces logging.basicConfig(): the root logger gets a QueueHandler
+    # and the real handlers run on a background thread
+    global _listener
+    with _setup_lock:
+        root = logging.getLogger()
+        if level is not None:
+            root.setLevel(level)
+        if _listener is not None:
+            return _listener
+        if not handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(fmt))
+            handlers = [handler]
+        q = queue.Queue()
+        handler = QueueHandler(q)
+        if rate:
+            handler.addFilter(RateLimitFilter(rate, burst))
+        _listener = QueueListener(q, *handlers)
+        _listener.start()
+        root.addHandler(handler)
+        atexit.register(_listener.stop)
+        return _listener
+
+
+def add_cell_handler(cell, handler):
+    if _listener is None:
+        raise RuntimeError("logging is not set up")
+    _listener.add_handler(handler, cell)
+
+
+def remove_cell_handler(cell, handler):
+    if _listener is not None:
+        _listener.remove_handler(handler, cell)
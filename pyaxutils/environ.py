@@ -0,0 +1,79 @@
+import os
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class Environ(Mapping):
+    # read-only environment for a child process: a snapshot shared by every
+    # layer built on it, plus a small overlay of what the layers changed;
+    # an overlay value of None unsets the variable
+    __slots__ = ("_base", "_names", "_overlay")
+
+    def __init__(self, base=None):
+        if isinstance(base, Environ):
+            self._base = base._base
+            self._names = base._names
+            self._overlay = base._overlay
+            return
+        self._base = dict(os.environ if base is None else base)
+        # windows names are case-insensitive, keep the snapshot's spelling
+        self._names = None
+        if os.name == "nt":
+            self._names = dict((k.upper(), k) for k in self._base)
+        self._overlay = {}
+
+    def _name(self, key):
+        if self._names is None:
+            return key
+        name = self._names.get(key.upper())
+        if name is None:
+            for k in self._overlay:
+                if k.upper() == key.upper():
+                    return k
+        return name or key
+
+    def __getitem__(self, key):
+        key = self._name(key)
+        if key in self._overlay:
+            value = self._overlay[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._base[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for k in self._base:
+            if k not in self._overlay:
+                yield k
+        for k, v in self._overlay.items():
+            if v is not None:
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def layer(self, values=None, **kwargs):
+        env = Environ.__new__(Environ)
+        env._base = self._base
+        env._names = self._names
+        env._overlay = dict(self._overlay)
+        for items in (values or {}, kwargs):
+            for k, v in items.items():
+                env._overlay[env._name(k)] = v
+        return env
+
+    def changes(self):
+        return dict(self._overlay)
+
+    def __repr__(self):
+        return "<Environ %d+%d>" % (len(self._base), len(self._overlay))
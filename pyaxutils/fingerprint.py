@@ -0,0 +1,319 @@
+import binascii
+import fnmatch
+import hashlib
+import logging
+import marshal
+import mmap
+import os
+import re
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+if __package__:
+    from . import utils
+else:
+    import utils
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+CACHE_DIR = os.path.join(utils.CACHE_DIR, "fingerprints")
+CACHE_VERSION = 2
+DIGEST_SIZE = 20
+IGNORE_PATTERNS = (".git", ".hg", ".svn", "__pycache__", "*.pyc")
+MMAP_MIN_SIZE = 64 * 1024
+# files changed this close to the scan may change again within the mtime
+# resolution, so their hashes are not trusted on the next run
+RACY_SECONDS = 2.0
+# with more changed paths than this a full scan is cheaper
+MAX_RESCAN_PATHS = 64
+
+
+def _digest(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size >= MMAP_MIN_SIZE:
+            try:
+                m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                m = None
+            if m is not None:
+                try:
+                    h.update(m)
+                finally:
+                    m.close()
+                return h.digest()
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def hash_file(filename):
+    return binascii.hexlify(_digest(filename)).decode("ascii")
+
+
+def compile_ignore(patterns):
+    # patterns with a "/" match the path relative to the tree, the others
+    # any single name in it
+    names = [fnmatch.translate(x) for x in patterns if "/" not in x]
+    paths = [fnmatch.translate(x) for x in patterns if "/" in x]
+    return (names and re.compile("|".join(names)).match,
+            paths and re.compile("|".join(paths)).match)
+
+
+def exclude_patterns(top, exclude):
+    # patterns for the dirs in exclude that lie inside top, such as a build
+    # dir placed in a source tree
+    patterns = []
+    for x in exclude:
+        try:
+            rel = os.path.relpath(os.path.abspath(x), top)
+        except ValueError:
+            # another drive
+            continue
+        if rel == os.curdir or rel == os.pardir or \
+                rel.startswith(os.pardir + os.sep):
+            continue
+        rel = rel.replace(os.sep, "/")
+        patterns += [rel, rel + "/*"]
+    return patterns
+
+
+def _listdir(path):
+    # (name, is_dir, stat) for every entry, following file symlinks
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, True, None
+                elif entry.is_file():
+                    yield entry.name, False, entry.stat()
+            except OSError:
+                continue
+        return
+    import stat
+    for name in os.listdir(path):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.islink(os.path.join(path, name)):
+                yield name, True, None
+        elif stat.S_ISREG(st.st_mode):
+            yield name, False, st
+
+
+def scan(top, ignore=IGNORE_PATTERNS, start=""):
+    # relative path -> (size, mtime, inode) for every file under top, or
+    # only under its subdirectory start
+    ignore_name, ignore_path = compile_ignore(ignore)
+    files = {}
+    stack = [start]
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = _listdir(os.path.join(top, rel) if rel else top)
+            for name, is_dir, st in entries:
+                if ignore_name and ignore_name(name):
+                    continue
+                path = rel + "/" + name if rel else name
+                if ignore_path and ignore_path(path):
+                    continue
+                if is_dir:
+                    stack.append(path)
+                else:
+                    files[path] = (st.st_size, st.st_mtime, st.st_ino)
+        except OSError as e:
+            logger.debug("cannot scan %s: %s", rel or top, e)
+    return files
+
+
+def _hash_files(top, paths, num_workers):
+    results = {}
+    paths = iter(paths)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                path = next(paths, None)
+            if path is None:
+                return
+            try:
+                results[path] = _digest(os.path.join(top, path))
+            except (IOError, OSError) as e:
+                # removed since the scan
+                logger.debug("cannot hash %s: %s", path, e)
+
+    # hashlib drops the GIL on large updates, so threads do run in parallel
+    threads = [threading.Thread(target=worker) for _ in range(num_workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _cache_file(cache_dir, top):
+    key = hashlib.sha1(top.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "%s.marshal" % key)
+
+
+class Fingerprinter:
+    def __init__(self,
+                 cache_dir=CACHE_DIR,
+                 ignore=IGNORE_PATTERNS,
+                 num_workers=None,
+                 exclude=()):
+        self.cache_dir = cache_dir
+        self.ignore = tuple(ignore)
+        self.exclude = tuple(os.path.abspath(x) for x in exclude)
+        self.num_workers = num_workers or min(8, utils.cpu_count())
+        # top -> (patterns, compiled patterns)
+        self._ignores = {}
+        # top -> (scan time, entries) of the last scan in this process
+        self._memory = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _load(self, top):
+        if not self.cache_dir:
+            return {}
+        try:
+            with open(_cache_file(self.cache_dir, top), "rb") as fd:
+                version, ignore, columns = marshal.load(fd)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return {}
+        if version != CACHE_VERSION or \
+                tuple(ignore) != self._patterns(top)[0]:
+            return {}
+        paths, sizes, mtimes, inodes, digests = columns
+        digests = [digests[i:i + DIGEST_SIZE]
+                   for i in range(0, len(digests), DIGEST_SIZE)]
+        return dict(zip(paths, zip(sizes, mtimes, inodes, digests)))
+
+    def _save(self, top, entries):
+        # stored as columns, which marshal loads several times faster than
+        # one tuple per file
+        paths = list(entries)
+        values = [entries[x] for x in paths]
+        columns = (paths,
+                   [x[0] for x in values],
+                   [x[1] for x in values],
+                   [x[2] for x in values],
+                   b"".join(x[3] for x in values))
+        filename = _cache_file(self.cache_dir, top)
+        try:
+            with utils.atomic_write(filename, "wb") as fd:
+                marshal.dump((CACHE_VERSION, self._patterns(top)[0], columns),
+                             fd)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("cannot write %s: %s", filename, e)
+
+    def hashes(self, top):
+        # relative path -> sha1 of its content, for every file under top
+        return dict((k, binascii.hexlify(v).decode("ascii"))
+                    for k, v in self.digests(top).items())
+
+    def digests(self, top, changed=None):
+        # changed: the only paths that may differ since the last call for
+        # top, the rest of the tree is then not scanned again
+        top = os.path.abspath(top)
+        with self._lock:
+            lock = self._locks.setdefault(top, threading.Lock())
+        # one scan of a tree at a time, the others then hit its cache
+        with lock:
+            return self._hashes(top, changed)
+
+    def _patterns(self, top):
+        result = self._ignores.get(top)
+        if result is None:
+            patterns = self.ignore + tuple(exclude_patterns(top, self.exclude))
+            result = self._ignores[top] = (patterns,
+                                           compile_ignore(patterns))
+        return result
+
+    def _ignored(self, top, path):
+        ignore_name, ignore_path = self._patterns(top)[1]
+        if ignore_name and any(ignore_name(x) for x in path.split("/")):
+            return True
+        return bool(ignore_path and ignore_path(path))
+
+    def _rescan(self, top, cached, paths):
+        files = dict((k, tuple(v[:3])) for k, v in cached.items())
+        for path in paths:
+            prefix = path + "/"
+            for k in [k for k in files if k.startswith(prefix)]:
+                del files[k]
+            files.pop(path, None)
+            if self._ignored(top, path):
+                continue
+            filename = os.path.join(top, path)
+            if os.path.isdir(filename):
+                files.update(scan(top, self._patterns(top)[0], path))
+            elif os.path.isfile(filename):
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime, st.st_ino)
+        return files
+
+    def _hashes(self, top, paths=None):
+        start = time.time()
+        memory = self._memory.get(top)
+        if memory is not None:
+            scanned, cached = memory
+        else:
+            # the disk cache holds no racy entries
+            scanned, cached = float("inf"), self._load(top)
+        if memory is not None and paths is not None and \
+                len(paths) <= MAX_RESCAN_PATHS:
+            files = self._rescan(top, cached, paths)
+        else:
+            files = scan(top, self._patterns(top)[0])
+        racy = scanned - RACY_SECONDS
+        entries = {}
+        changed = []
+        for path, st in files.items():
+            entry = cached.get(path)
+            if entry is not None and tuple(entry[:3]) == st and \
+                    entry[1] < racy:
+                entries[path] = entry
+            else:
+                changed.append(path)
+        hashed = {}
+        if changed:
+            hashed = _hash_files(top, changed,
+                                 min(self.num_workers, len(changed)))
+            for path, digest in hashed.items():
+                entries[path] = files[path] + (digest,)
+        logger.debug("%s: %d files, %d hashed in %.3fs",
+                     top, len(files), len(hashed), time.time() - start)
+
+        self._memory[top] = (start, entries)
+        if self.cache_dir and (hashed or len(entries) != len(cached)):
+            racy = start - RACY_SECONDS
+            self._save(top, dict((k, v) for k, v in entries.items()
+                                 if v[1] < racy))
+        return dict((k, v[3]) for k, v in entries.items())
+
+    def fingerprint(self, top, changed=None):
+        h = hashlib.sha1()
+        for path, digest in sorted(self.digests(top, changed).items()):
+            if not isinstance(path, bytes):
+                path = path.encode("utf-8")
+            h.update(path)
+            h.update(b"\0" + digest)
+        return h.hexdigest()
+
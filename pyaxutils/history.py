@@ -0,0 +1,198 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+HISTORY_FILENAME = ".build-history.sqlite"
+# how many recent runs estimates are taken from
+RECENT_RUNS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    elapsed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    cell TEXT NOT NULL,
+    target TEXT NOT NULL,
+    step TEXT NOT NULL,
+    duration REAL NOT NULL,
+    returncode INTEGER NOT NULL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS steps_cell ON steps (cell, step);
+"""
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+class History:
+    def __init__(self, filename):
+        self.filename = filename
+        self.started = time.time()
+        self._steps = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename)
+        db.executescript(SCHEMA)
+        return db
+
+    def _query(self, sql, args=()):
+        if sqlite3 is None or not self.filename or \
+                not os.path.isfile(self.filename):
+            return []
+        db = self._connect()
+        try:
+            return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+    def record(self, cell, step, duration, returncode, fingerprint=None):
+        # kept in memory, flush() writes the whole run at once
+        with self._lock:
+            self._steps.append((str(cell), cell.target, step, duration,
+                                returncode, fingerprint))
+
+    def flush(self):
+        with self._lock:
+            steps, self._steps = self._steps, []
+        if not steps or not self.filename:
+            return
+        if sqlite3 is None:
+            logger.warning("sqlite3 is not available, build history is off")
+            return
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    run_id = db.execute(
+                        "INSERT INTO runs (started, elapsed) VALUES (?, ?)",
+                        (self.started, time.time() - self.started)).lastrowid
+                    db.executemany(
+                        "INSERT INTO steps (run_id, cell, target, step, "
+                        "duration, returncode, fingerprint) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(run_id,) + x for x in steps])
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.warning("cannot write %s: %s", self.filename, e)
+
+    def durations(self):
+        # cell -> expected seconds for all its steps, averaged over the
+        # recent successful runs of each step
+        rows = self._query(
+            "SELECT cell, step, AVG(duration) FROM steps "
+            "WHERE returncode = 0 AND run_id > "
+            "(SELECT MAX(id) FROM runs) - ? "
+            "GROUP BY cell, step", (RECENT_RUNS,))
+        result = {}
+        for cell, step, duration in rows:
+            result[cell] = result.get(cell, 0.0) + duration
+        return result
+
+    def slowest(self, limit=10):
+        # average time a target's steps took per run, over all its cells
+        return self._query(
+            "SELECT target, AVG(total), COUNT(*) FROM "
+            "(SELECT target, run_id, SUM(duration) AS total FROM steps "
+            "WHERE returncode = 0 GROUP BY target, run_id) "
+            "GROUP BY target ORDER BY AVG(total) DESC LIMIT ?", (limit,))
+
+    def flakiest(self, limit=10):
+        # steps that both failed and passed with the same fingerprint,
+        # i.e. without any change to their inputs
+        return self._query(
+            "SELECT target, COUNT(DISTINCT cell || ':' || step), "
+            "SUM(failed), SUM(runs) FROM "
+            "(SELECT target, cell, step, fingerprint, "
+            "SUM(returncode != 0) AS failed, COUNT(*) AS runs FROM steps "
+            "GROUP BY target, cell, step, fingerprint "
+            "HAVING SUM(returncode != 0) > 0 AND SUM(returncode = 0) > 0) "
+            "GROUP BY target ORDER BY SUM(failed) * 1.0 / SUM(runs) DESC, "
+            "SUM(failed) DESC LIMIT ?", (limit,))
+
+    def write_report(self, out, limit=10):
+        runs = self._query("SELECT COUNT(*), MAX(started) FROM runs")
+        if not runs or not runs[0][0]:
+            out.write("no build history in %s\n" % self.filename)
+            return
+        out.write("%d runs recorded in %s, the last on %s\n" % (
+            runs[0][0], self.filename,
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(runs[0][1]))))
+        out.write("\nslowest targets (average per run):\n")
+        for target, duration, count in self.slowest(limit):
+            out.write("  %-30s %10s  (%d runs)\n" % (
+                target, format_duration(duration), count))
+        out.write("\nflakiest targets (failed with unchanged inputs):\n")
+        rows = self.flakiest(limit)
+        for target, steps, failed, total in rows:
+            out.write("  %-30s %d of %d step runs failed, in %d step(s)\n"
+                      % (target, failed, total, steps))
+        if not rows:
+            out.write("  none\n")
+
+
+class Progress:
+    # logs how many cells are done and an estimate of the time left
+    def __init__(self, cells, durations, num_workers=1):
+        known = [durations[str(x)] for x in cells if str(x) in durations]
+        default = sum(known) / len(known) if known else None
+        self.expected = dict((x, durations.get(str(x), default))
+                             for x in cells)
+        self.num_workers = max(1, num_workers or 1)
+        self.started = {}
+        self.done = set()
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def start(self, cell):
+        with self._lock:
+            self.started[cell] = time.time()
+
+    def finish(self, cell, failed=False):
+        # done holds every finished cell, failed ones included
+        with self._lock:
+            self.done.add(cell)
+            if failed:
+                self.failed.add(cell)
+            done, num_failed = len(self.done), len(self.failed)
+            eta = self.eta()
+        msg = "%d/%d cells done" % (done - num_failed, len(self.expected))
+        if num_failed:
+            msg += ", %d failed" % num_failed
+        if eta is not None and done < len(self.expected):
+            msg += ", about %s left" % format_duration(eta)
+        logger.info("%s", msg)
+
+    def eta(self):
+        now = time.time()
+        left = []
+        for cell, expected in self.expected.items():
+            if cell in self.done:
+                continue
+            if expected is None:
+                return None
+            if cell in self.started:
+                expected = max(0.0, expected - (now - self.started[cell]))
+            left.append(expected)
+        if not left:
+            return 0.0
+        return max(sum(left) / min(self.num_workers, len(left)), max(left))
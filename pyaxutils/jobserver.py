@@ -0,0 +1,234 @@
+import errno
+import logging
+import os
+import re
+import select
+import sys
+import threading
+
+if __package__:
+    from . import utils
+else:
+    import utils
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+# how often a thread waiting for a token checks for the implicit one
+POLL_INTERVAL = 0.2
+TOKEN = b"+"
+# stands for the pipe or semaphore a real run would create
+PLAN_AUTH = "<jobserver>"
+
+_AUTH_RE = re.compile(r"--jobserver-(?:auth|fds)=(\S+)")
+_JOBS_RE = re.compile(r"^-j\d*$|^--jobserver-(?:auth|fds)=")
+
+
+def _inheritable(fd):
+    if hasattr(os, "set_inheritable"):
+        os.set_inheritable(fd, True)
+    return fd
+
+
+class _Pipe:
+    # the posix jobserver: a pipe holding one byte per free token
+    def __init__(self, read_fd, write_fd, auth, owned=True):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.auth = auth
+        self.fds = (read_fd, write_fd)
+        # descriptors passed down by a parent make stay open for it
+        self.owned = owned
+
+    @classmethod
+    def create(cls, tokens):
+        r, w = os.pipe()
+        os.write(w, TOKEN * tokens)
+        return cls(_inheritable(r), _inheritable(w), "%d,%d" % (r, w))
+
+    @classmethod
+    def open(cls, auth):
+        if auth.startswith("fifo:"):
+            # make 4.4+ names a fifo instead of passing descriptors
+            fd = os.open(auth[len("fifo:"):], os.O_RDWR)
+            return cls(fd, fd, auth)
+        r, w = [int(x) for x in auth.split(",")]
+        # make closes them for children not marked recursive with "+"
+        os.fstat(r)
+        os.fstat(w)
+        return cls(_inheritable(r), _inheritable(w), auth, owned=False)
+
+    def wait(self, timeout):
+        try:
+            readable, _, _ = select.select([self.read_fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return None
+            raise
+        if not readable:
+            return None
+        try:
+            # another process may win the race for the byte, then this
+            # blocks until the next token comes back
+            return os.read(self.read_fd, 1) or None
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return None
+            raise
+
+    def post(self, token):
+        os.write(self.write_fd, token)
+
+    def close(self):
+        if self.owned:
+            for fd in set(self.fds):
+                os.close(fd)
+
+
+class _Semaphore:
+    # the windows jobserver: a named semaphore counting free tokens
+    def __init__(self, handle, auth):
+        import ctypes
+        self.kernel32 = ctypes.windll.kernel32
+        self.handle = handle
+        self.auth = auth
+        self.fds = ()
+
+    @classmethod
+    def create(cls, tokens):
+        import ctypes
+        auth = "gmake_semaphore_%d" % os.getpid()
+        handle = ctypes.windll.kernel32.CreateSemaphoreW(
+            None, tokens, max(1, tokens), auth)
+        if not handle:
+            raise ctypes.WinError()
+        return cls(handle, auth)
+
+    @classmethod
+    def open(cls, auth):
+        import ctypes
+        # SYNCHRONIZE | SEMAPHORE_MODIFY_STATE
+        handle = ctypes.windll.kernel32.OpenSemaphoreW(0x00100002, False,
+                                                        auth)
+        if not handle:
+            raise ctypes.WinError()
+        return cls(handle, auth)
+
+    def wait(self, timeout):
+        # WAIT_OBJECT_0
+        if self.kernel32.WaitForSingleObject(self.handle,
+                                             int(timeout * 1000)) == 0:
+            return TOKEN
+        return None
+
+    def post(self, token):
+        self.kernel32.ReleaseSemaphore(self.handle, 1, None)
+
+    def close(self):
+        self.kernel32.CloseHandle(self.handle)
+
+
+_Server = _Semaphore if sys.platform == "win32" else _Pipe
+
+
+def _makeflags(jobs, auth, makeflags=None):
+    # keep any other flags the caller passed to make; a leading word
+    # without a dash holds single-letter flags
+    words = (makeflags or "").split()
+    if words and not words[0].startswith("-") and "=" not in words[0]:
+        words[0] = "-" + words[0]
+    flags = [x for x in words if not _JOBS_RE.match(x)]
+    return " ".join(["-j%d" % jobs, "--jobserver-auth=%s" % auth] + flags)
+
+
+class Jobserver:
+    # hands out the GNU make jobserver tokens of one -j budget. Like make,
+    # the process owns one implicit token, every other job in flight holds
+    # a token taken from the server; a step's child make then runs its
+    # first job on its cell's token and takes the rest from the same server
+    def __init__(self, server, jobs=None, inherited=False, makeflags=""):
+        self.server = server
+        self.jobs = jobs
+        self.inherited = inherited
+        self.fds = server.fds
+        self.makeflags = makeflags
+        self._implicit = True
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, jobs, makeflags=None):
+        jobs = max(1, jobs or 1)
+        server = _Server.create(jobs - 1)
+        makeflags = _makeflags(jobs, server.auth, makeflags)
+        logger.debug("jobserver with %d tokens: %s", jobs, makeflags)
+        return cls(server, jobs, False, makeflags)
+
+    @classmethod
+    def inherit(cls, makeflags):
+        # the jobserver of a make we are running under, or None
+        auth = _AUTH_RE.findall(makeflags or "")
+        if not auth:
+            return None
+        try:
+            server = _Server.open(auth[-1])
+        except (OSError, ValueError) as e:
+            logger.warning("jobserver unavailable (%s), add '+' to the "
+                           "parent make rule", e)
+            return None
+        logger.debug("using the inherited jobserver %s", auth[-1])
+        return cls(server, None, True, makeflags)
+
+    def max_workers(self, jobs, num_jobs):
+        # under a parent make its tokens bound how many jobs run at once;
+        # the workers waiting for one are capped all the same
+        if not self.inherited:
+            return jobs
+        return max(1, min(num_jobs, max(jobs, utils.cpu_count())))
+
+    @property
+    def environ(self):
+        return dict(MAKEFLAGS=self.makeflags)
+
+    def acquire(self):
+        # blocks until a token is free; None stands for the implicit one
+        while True:
+            with self._lock:
+                if self._implicit:
+                    self._implicit = False
+                    return None
+            token = self.server.wait(POLL_INTERVAL)
+            if token is not None:
+                return token
+
+    def release(self, token):
+        if token is None:
+            with self._lock:
+                self._implicit = True
+        else:
+            self.server.post(token)
+
+    def run(self, func, *args):
+        token = self.acquire()
+        try:
+            return func(*args)
+        finally:
+            self.release(token)
+
+    def close(self):
+        self.server.close()
+
+
+def setup(jobs, environ=None):
+    # joins the jobserver of a parent make, otherwise starts one for jobs
+    environ = os.environ if environ is None else environ
+    makeflags = environ.get("MAKEFLAGS", "")
+    return Jobserver.inherit(makeflags) or \
+        Jobserver.create(jobs, makeflags)
+
+
+def plan_environ(jobs, environ=None):
+    # what setup() would export, without opening or creating a jobserver
+    environ = os.environ if environ is None else environ
+    makeflags = environ.get("MAKEFLAGS", "")
+    if not _AUTH_RE.search(makeflags):
+        makeflags = _makeflags(max(1, jobs or 1), PLAN_AUTH, makeflags)
+    return dict(MAKEFLAGS=makeflags)
@@ -1,74 +1,315 @@
 import os
 import re
+import bisect
 import sys
+import json
+import subprocess
+import threading
 
 import logging
 logger = logging.getLogger("find_msvc")
 
+if __package__:
+    from . import environ, utils
+else:
+    import environ
+    import utils
+
 
 VS_VERS = ["2019", "2017"]
 VS_INSTALL_TYPES = ["BuildTools", "Community"]
 VC_ARCH = ["x86", "x64"]
 
-INSTALLED_MSVC = {}
-PROGRAMFILES_X86 = os.environ["PROGRAMFILES(X86)"]
-
-for vs_ver, vs_install in [(vs_ver, vs_install)
-                           for vs_ver in VS_VERS
-                           for vs_install in VS_INSTALL_TYPES]:
-    logger.debug("checking %s(%s) ...", vs_ver, vs_install)
-    vs_install_dir = os.path.join(
-        PROGRAMFILES_X86,
-        "Microsoft Visual Studio", vs_ver, vs_install, "VC")
-    if not os.path.isdir(vs_install_dir):
-        continue
-    logger.debug("install found: %s .", vs_install_dir)
-
-    vcvarsall_bat = os.path.join(vs_install_dir,
-                                 "Auxiliary",
-                                 "Build", "vcvarsall.bat")
-    if not os.path.isfile(vcvarsall_bat):
-        logger.debug("vcvarsall.bat not found. %s", vcvarsall_bat)
-        continue
-    vc_toolset_dir = os.path.join(vs_install_dir,
-                                  "Tools",
-                                  "MSVC")
-    for toolset in os.listdir(vc_toolset_dir):
-        if not re.match(r"\d+\.\d+.\d+.", toolset):
-            logger.debug("%s is not avalid toolset dir", toolset)
+ENV_CACHE_FILE = os.path.join(utils.CACHE_DIR, "msvc-environ.json")
+ENV_MARKER = "--- pyaxutils environ ---"
+# set by the capturing shell itself, never by vcvarsall
+VOLATILE_ENV = frozenset(["_", "SHLVL", "PWD", "OLDPWD", "PROMPT"])
+
+DISCOVERY_CACHE_FILE = os.path.join(utils.CACHE_DIR, "msvc-installed.json")
+
+
+def default_search_roots():
+    roots = []
+    for var in ("PROGRAMFILES(X86)", "PROGRAMFILES"):
+        if os.environ.get(var):
+            root = os.path.join(os.environ[var], "Microsoft Visual Studio")
+            if root not in roots:
+                roots.append(root)
+    return roots
+
+
+def _install_dirs(roots):
+    for root in roots:
+        for vs_ver in VS_VERS:
+            for vs_install in VS_INSTALL_TYPES:
+                yield root, vs_ver, vs_install
+
+
+def _watched_paths(roots):
+    paths = []
+    for root, vs_ver, vs_install in _install_dirs(roots):
+        vs_install_dir = os.path.join(root, vs_ver, vs_install, "VC")
+        paths += [
+            os.path.join(root, vs_ver),
+            os.path.join(root, vs_ver, vs_install),
+            os.path.join(vs_install_dir, "Auxiliary", "Build",
+                         "vcvarsall.bat"),
+            os.path.join(vs_install_dir, "Tools", "MSVC"),
+        ]
+    return roots + paths
+
+
+def scan_msvc(roots):
+    installed = {}
+    for root, vs_ver, vs_install in _install_dirs(roots):
+        logger.debug("checking %s(%s) in %s ...", vs_ver, vs_install, root)
+        vs_install_dir = os.path.join(root, vs_ver, vs_install, "VC")
+        if not os.path.isdir(vs_install_dir):
+            continue
+        logger.debug("install found: %s .", vs_install_dir)
+
+        vcvarsall_bat = os.path.join(vs_install_dir,
+                                     "Auxiliary",
+                                     "Build", "vcvarsall.bat")
+        if not os.path.isfile(vcvarsall_bat):
+            logger.debug("vcvarsall.bat not found. %s", vcvarsall_bat)
+            continue
+        vc_toolset_dir = os.path.join(vs_install_dir,
+                                      "Tools",
+                                      "MSVC")
+        if not os.path.isdir(vc_toolset_dir):
             continue
-        logger.debug("found toolset: %s", toolset)
-        if toolset not in INSTALLED_MSVC:
-            INSTALLED_MSVC[toolset] = []
-        INSTALLED_MSVC[toolset].append(
-            dict(
-                toolset=toolset,
-                vs_ver=vs_ver,
-                vs_install=vs_install,
-                vs_install_dir=vs_install_dir,
-                vcvarsall_bat=vcvarsall_bat,
-                vc_toolset_dir=vc_toolset_dir,
+        for toolset in sorted(os.listdir(vc_toolset_dir)):
+            if not re.match(r"\d+\.\d+.\d+.", toolset):
+                logger.debug("%s is not avalid toolset dir", toolset)
+                continue
+            logger.debug("found toolset: %s", toolset)
+            installed.setdefault(toolset, []).append(
+                dict(
+                    toolset=toolset,
+                    vs_ver=vs_ver,
+                    vs_install=vs_install,
+                    vs_install_dir=vs_install_dir,
+                    vcvarsall_bat=vcvarsall_bat,
+                    vc_toolset_dir=vc_toolset_dir,
+                )
             )
-        )
-        continue
-    continue
+    return installed
 
 
-def find_msvc(toolset=None,
-              logger=logger):
+def _load_discovery_cache(cache_file, roots, mtimes):
+    try:
+        with open(cache_file) as fd:
+            cache = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get("roots") != roots or cache.get("mtimes") != mtimes:
+        logger.debug("%s is out of date", cache_file)
+        return None
+    return cache.get("installed")
+
+
+def parse_version(version):
+    return tuple(int(x) for x in re.findall(r"\d+", version))
+
+
+class ToolsetIndex:
+    def __init__(self, installed):
+        self.installed = installed
+        self._toolsets = dict((parse_version(x), x) for x in installed)
+        # every string prefix of every toolset -> its versions, ascending,
+        # so "14.1" keeps matching "14.16.27023" as startswith() did
+        by_prefix = {}
+        for toolset in installed:
+            version = parse_version(toolset)
+            for i in range(len(toolset) + 1):
+                by_prefix.setdefault(toolset[:i], []).append(version)
+        for versions in by_prefix.values():
+            versions.sort()
+        self._by_prefix = by_prefix
+
+    def versions(self, toolset=None):
+        return self._by_prefix.get(toolset or "", [])
+
+    def find(self, toolset=None, min_version=None, max_version=None):
+        # the newest matching toolset, both bounds inclusive; a bound names
+        # as many components as it cares about, so "14.16" takes in every
+        # 14.16.x
+        versions = self.versions(toolset)
+        hi = len(versions)
+        if max_version is not None:
+            bound = parse_version(max_version)
+            if bound:
+                hi = bisect.bisect_left(versions,
+                                        bound[:-1] + (bound[-1] + 1,))
+        if not hi:
+            return None
+        version = versions[hi - 1]
+        if min_version is not None and version < parse_version(min_version):
+            return None
+        return self._toolsets[version]
+
+    def select(self, toolset, prefer=None):
+        installs = self.installed[toolset]
+        if not prefer:
+            return installs[0]
+        if not isinstance(prefer, (list, tuple)):
+            prefer = [prefer]
+        prefer = list(prefer)
+
+        def rank(install):
+            for i, x in enumerate(prefer):
+                if x in (install["vs_install"], install["vs_ver"]):
+                    return i
+            return len(prefer)
+        return min(installs, key=rank)
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
 
-    toolsets = sorted([x for x in INSTALLED_MSVC.keys()
-                       if not toolset or x.startswith(toolset)
-                       ], reverse=True)
-    if not toolsets:
+def get_toolset_index(roots=None, cache_file=None, refresh=False):
+    roots = list(default_search_roots() if roots is None else roots)
+    key = tuple(roots)
+    with _index_lock:
+        if not refresh and key in _index_cache:
+            return _index_cache[key]
+
+        installed = None
+        if cache_file:
+            mtimes = dict((path, utils.getmtime(path))
+                          for path in _watched_paths(roots))
+            if not refresh:
+                installed = _load_discovery_cache(cache_file, roots, mtimes)
+        if installed is None:
+            installed = scan_msvc(roots)
+            if cache_file:
+                utils.save_json(cache_file, dict(roots=roots,
+                                                 mtimes=mtimes,
+                                                 installed=installed))
+        index = _index_cache[key] = ToolsetIndex(installed)
+        return index
+
+
+def get_installed_msvc(roots=None, cache_file=None, refresh=False):
+    return get_toolset_index(roots, cache_file, refresh).installed
+
+
+def find_msvc(toolset=None,
+              logger=logger,
+              roots=None,
+              cache_file=None,
+              min_version=None,
+              max_version=None,
+              prefer=None):
+    index = get_toolset_index(roots, cache_file)
+    found = index.find(toolset, min_version, max_version)
+    if found is None:
         raise RuntimeError("toolset '%s' not found" % toolset)
-    return INSTALLED_MSVC[toolsets[0]][0]
+    return index.select(found, prefer)
+
+
+def _env_key(key):
+    return key.upper() if os.name == "nt" else key
+
+
+def _parse_environ(output):
+    env = {}
+    lines = output.splitlines()
+    # cmd echoes any blanks before "&&" along with the marker
+    stripped = [x.strip() for x in lines]
+    if ENV_MARKER in stripped:
+        lines = lines[stripped.index(ENV_MARKER) + 1:]
+    for line in lines:
+        k, sep, v = line.partition("=")
+        if sep and k:
+            env[_env_key(k)] = v
+    return env
+
+
+def _diff_environ(base, env):
+    base = dict((_env_key(k), v) for k, v in base.items())
+    diff = dict(set={}, prepend={})
+    for k, v in env.items():
+        old = base.get(k)
+        if old == v or k in VOLATILE_ENV:
+            continue
+        if old and v.endswith(old):
+            diff["prepend"][k] = v[:-len(old)]
+        else:
+            diff["set"][k] = v
+    return diff
+
+
+def capture_environ(shell_setvars, base=None):
+    if sys.platform == "win32":
+        cmd = "%s && echo %s&& set" % (shell_setvars, ENV_MARKER)
+    else:
+        cmd = "%s && echo \"%s\" && env" % (shell_setvars, ENV_MARKER)
+    base = dict(os.environ if base is None else base)
+    logger.debug("capturing environ: %s", cmd)
+    output = subprocess.check_output(cmd, shell=True, env=base)
+    if not isinstance(output, str):
+        output = output.decode(sys.getfilesystemencoding() or "utf-8",
+                               "replace")
+    return _diff_environ(base, _parse_environ(output))
+
+
+def apply_environ(diff, base=None):
+    # layers the changes over base, which is shared rather than copied when
+    # it already is an Environ
+    env = environ.Environ(base)
+    changes = dict(diff["set"])
+    for k, v in diff["prepend"].items():
+        changes[k] = v + env.get(k, "")
+    return env.layer(changes)
+
+
+_environ_cache = {}
+_environ_lock = threading.Lock()
+
+
+def _load_environ_cache(cache_file):
+    try:
+        with open(cache_file) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def get_environ_diff(installed, arch, cache_file=ENV_CACHE_FILE,
+                     capture=True):
+    # capture=False only looks in the caches and returns None on a miss
+    vcvarsall_bat = installed["vcvarsall_bat"]
+    key = "%s|%s|%s" % (vcvarsall_bat, arch, installed["toolset"])
+    mtime = os.path.getmtime(vcvarsall_bat)
+    with _environ_lock:
+        entry = _environ_cache.get(key)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry["diff"]
+
+        cache = _load_environ_cache(cache_file) if cache_file else {}
+        entry = cache.get(key)
+        if entry is None or entry.get("mtime") != mtime:
+            if not capture:
+                return None
+            logger.debug("running vcvarsall for %s", key)
+            entry = dict(
+                mtime=mtime,
+                diff=capture_environ(MSVC(installed, arch).shell_setvars))
+            if cache_file:
+                cache[key] = entry
+                utils.save_json(cache_file, cache)
+        _environ_cache[key] = entry
+        return entry["diff"]
 
 
 class MSVC:
-    def __init__(self, installed, arch):
+    def __init__(self, installed, arch, cache_file=ENV_CACHE_FILE):
         self.installed = installed
         self.arch = arch
+        self.cache_file = cache_file
 
     def __repr__(self):
         return "<MSVC toolset=%s;arch=%s>" % (self.toolset, self.arch)
@@ -79,18 +320,31 @@ class MSVC:
 
     @property
     def shell_setvars(self):
+        if sys.platform != "win32":
+            # lets a POSIX stand-in for vcvarsall.bat export into the shell
+            return "set -- %s -vcvars_ver=%s && . \"%s\"" % (
+                self.arch,
+                self.installed["toolset"],
+                self.installed["vcvarsall_bat"])
         return "\"%s\" %s -vcvars_ver=%s" % (
             self.installed["vcvarsall_bat"],
             self.arch,
             self.installed["toolset"])
 
+    def environ(self, base=None, capture=True):
+        diff = get_environ_diff(self.installed, self.arch, self.cache_file,
+                                capture)
+        if diff is None:
+            return None
+        return apply_environ(diff, base)
+
 
-def get_msvc(arch, toolset=None):
-    return MSVC(find_msvc(toolset=toolset), arch)
+def get_msvc(arch, toolset=None, **kwargs):
+    return MSVC(find_msvc(toolset=toolset, **kwargs), arch)
 
 
 if __name__ == "__main__":
     if logger:
         logger.setLevel(0)
-    print get_msvc("x86")
+    print(get_msvc("x86"))
     pass
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger(
+    __package__ or os.path.basename(__file__))
+
+
+def critical_path(durations, depends=None):
+    # longest chain through the cell dependency graph, weighted by duration;
+    # without dependencies it is just the slowest cell
+    depends = depends or {}
+    best = {}
+
+    def visit(node, stack=()):
+        if node in best:
+            return best[node]
+        if node in stack:
+            raise RuntimeError("dependency cycle at '%s'" % (node,))
+        length, path = 0.0, []
+        for dep in depends.get(node, ()):
+            if dep in durations:
+                dep_length, dep_path = visit(dep, stack + (node,))
+                if dep_length > length:
+                    length, path = dep_length, dep_path
+        best[node] = (length + durations[node], path + [node])
+        return best[node]
+
+    length, path = 0.0, []
+    for node in durations:
+        node_length, node_path = visit(node)
+        if node_length > length:
+            length, path = node_length, node_path
+    return length, path
+
+
+class Recorder:
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.cells = {}
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def _tid(self):
+        ident = threading.current_thread().ident
+        if ident not in self._threads:
+            self._threads[ident] = len(self._threads)
+        return self._threads[ident]
+
+    @contextlib.contextmanager
+    def phase(self, name, cell=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self.events.append(dict(name=name,
+                                        cell=cell and str(cell),
+                                        start=start - self.start,
+                                        duration=end - start,
+                                        tid=self._tid()))
+
+    @contextlib.contextmanager
+    def cell(self, cell):
+        key = str(cell)
+        with self._lock:
+            self.cells[key] = dict(status="running",
+                                   start=time.time() - self.start,
+                                   duration=None)
+        try:
+            with self.phase("cell", cell):
+                yield
+        except BaseException:
+            self.set_status(cell, "failed")
+            raise
+        finally:
+            with self._lock:
+                info = self.cells[key]
+                info["duration"] = time.time() - self.start - info["start"]
+                if info["status"] == "running":
+                    info["status"] = "done"
+
+    def set_status(self, cell, status):
+        with self._lock:
+            # cells that never started, e.g. skipped ones, get an entry too
+            info = self.cells.setdefault(str(cell),
+                                         dict(start=None, duration=None))
+            info["status"] = status
+
+    def to_dict(self, depends=None):
+        with self._lock:
+            events = list(self.events)
+            cells = dict((k, dict(v)) for k, v in self.cells.items())
+        for event in events:
+            if event["cell"] in cells and event["name"] != "cell":
+                phases = cells[event["cell"]].setdefault("phases", {})
+                phases[event["name"]] = \
+                    phases.get(event["name"], 0.0) + event["duration"]
+        durations = dict((k, v["duration"] or 0.0) for k, v in cells.items())
+        length, path = critical_path(durations, depends)
+        return dict(
+            elapsed=time.time() - self.start,
+            phases=[x for x in events if x["cell"] is None],
+            cells=cells,
+            critical_path=dict(duration=length, cells=path),
+        )
+
+    def write_json(self, filename, depends=None):
+        with open(filename, "w") as fd:
+            json.dump(self.to_dict(depends), fd, indent=1, sort_keys=True)
+        _logger.info("build report written to %s", filename)
+
+    def write_trace(self, filename):
+        with self._lock:
+            events = list(self.events)
+        trace = [dict(name=x["name"] if x["name"] != "cell" else x["cell"],
+                      cat=x["cell"] and "cell" or "run",
+                      ph="X",
+                      ts=int(x["start"] * 1e6),
+                      dur=int(x["duration"] * 1e6),
+                      pid=os.getpid(),
+                      tid=x["tid"],
+                      args=dict(cell=x["cell"]))
+                 for x in events]
+        with open(filename, "w") as fd:
+            json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), fd)
+        _logger.info("trace written to %s", filename)
@@ -0,0 +1,94 @@
+import collections
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(
+    __package__ or os.path.basename(__file__))
+
+# longest chunk read at once, so a child printing without newlines cannot
+# make a single "line" grow without bound
+MAX_LINE = 64 * 1024
+TAIL_LINES = 50
+
+
+class StepResult:
+    def __init__(self, cmd, returncode, elapsed, log_file, tail):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.log_file = log_file
+        self.tail = tail
+
+    def __repr__(self):
+        return "<StepResult returncode=%s;elapsed=%.3f;log_file=%s>" % (
+            self.returncode, self.elapsed, self.log_file)
+
+
+class StepFailed(RuntimeError):
+    def __init__(self, result):
+        RuntimeError.__init__(
+            self, "command %r returned non-zero exit status %d" % (
+                result.cmd, result.returncode))
+        self.result = result
+
+
+def _pump(stream, log, tail, on_line):
+    try:
+        for line in iter(lambda: stream.readline(MAX_LINE), b""):
+            if log is not None:
+                log.write(line)
+            tail.append(line)
+            if on_line is not None:
+                on_line(line)
+    finally:
+        stream.close()
+
+
+def run(cmd,
+        cwd=None,
+        env=None,
+        shell=True,
+        log_file=None,
+        on_line=None,
+        tail_lines=TAIL_LINES,
+        check=True,
+        pass_fds=()):
+    kwargs = {}
+    if pass_fds and sys.version_info[0] >= 3:
+        # python 2 leaves inheritable descriptors open anyway
+        kwargs["pass_fds"] = pass_fds
+
+    tail = collections.deque(maxlen=tail_lines)
+    log = open(log_file, "wb") if log_file else None
+    try:
+        start = time.time()
+        proc = subprocess.Popen(cmd,
+                                cwd=cwd,
+                                env=env,
+                                shell=shell,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                **kwargs)
+        reader = threading.Thread(target=_pump,
+                                  args=(proc.stdout, log, tail, on_line))
+        reader.daemon = True
+        reader.start()
+        returncode = proc.wait()
+        reader.join()
+        elapsed = time.time() - start
+        if log is not None:
+            log.write(("\n# exit %d after %.3fs\n" % (
+                returncode, elapsed)).encode("utf-8"))
+    finally:
+        if log is not None:
+            log.close()
+
+    result = StepResult(cmd, returncode, elapsed, log_file, list(tail))
+    _logger.debug("%s", result)
+    if check and returncode:
+        raise StepFailed(result)
+    return result
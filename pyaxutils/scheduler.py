@@ -0,0 +1,220 @@
+import collections
+import heapq
+import logging
+import os
+import threading
+
+_logger = logging.getLogger(
+    __package__ or os.path.basename(__file__))
+
+
+class JobsFailed(RuntimeError):
+    def __init__(self, failures, blocked=()):
+        RuntimeError.__init__(
+            self, "%d job(s) failed: %s" % (
+                len(failures), ", ".join(str(job) for job, _ in failures)))
+        self.failures = failures
+        self.blocked = list(blocked)
+
+
+class DependencyCycle(RuntimeError):
+    def __init__(self, cycle):
+        RuntimeError.__init__(
+            self, "dependency cycle: %s" % " -> ".join(str(x) for x in cycle))
+        self.cycle = cycle
+
+
+def _find_cycle(jobs, depends):
+    # only called once toposort() knows every job left in `jobs` is on or
+    # behind a cycle, so walking dependencies must revisit some job
+    job = jobs[0]
+    jobs = set(jobs)
+    path = []
+    seen = {}
+    while job not in seen:
+        seen[job] = len(path)
+        path.append(job)
+        job = next(x for x in depends.get(job, ()) if x in jobs)
+    return path[seen[job]:] + [job]
+
+
+class Graph:
+    def __init__(self, jobs, depends=None):
+        depends = depends or {}
+        self.jobs = list(jobs)
+        index = set(self.jobs)
+        self.depends = dict(
+            (job, [x for x in depends.get(job, ()) if x in index])
+            for job in self.jobs)
+        self.dependents = dict((job, []) for job in self.jobs)
+        for job in self.jobs:
+            for dep in self.depends[job]:
+                self.dependents[dep].append(job)
+
+    def toposort(self, priority=None):
+        # with priority (job -> weight) the heaviest ready job comes first,
+        # otherwise jobs keep their given order
+        pending = dict((job, len(self.depends[job])) for job in self.jobs)
+        ready = _ReadyQueue(self, priority)
+        for job in self.jobs:
+            if not pending[job]:
+                ready.push(job)
+        order = []
+        while ready:
+            job = ready.pop()
+            order.append(job)
+            for dep in self.dependents[job]:
+                pending[dep] -= 1
+                if not pending[dep]:
+                    ready.push(dep)
+        if len(order) != len(self.jobs):
+            left = [job for job in self.jobs if pending[job]]
+            raise DependencyCycle(_find_cycle(left, self.depends))
+        return order
+
+    def critical_weights(self, durations, default=0.0):
+        # a job's own duration plus the longest chain of jobs waiting on
+        # it, so starting the heaviest job first shortens the whole run
+        weights = {}
+        for job in reversed(self.toposort()):
+            weights[job] = durations.get(job, default) + max(
+                [weights[x] for x in self.dependents[job]] or [0.0])
+        return weights
+
+    def downstream(self, job):
+        result = []
+        stack = list(self.dependents[job])
+        seen = set()
+        while stack:
+            job = stack.pop()
+            if job in seen:
+                continue
+            seen.add(job)
+            result.append(job)
+            stack.extend(self.dependents[job])
+        return result
+
+
+class _ReadyQueue:
+    def __init__(self, graph, priority=None):
+        self.priority = priority
+        self.index = dict((job, i) for i, job in enumerate(graph.jobs))
+        self.items = collections.deque() if priority is None else []
+
+    def push(self, job):
+        if self.priority is None:
+            self.items.append(job)
+        else:
+            heapq.heappush(self.items, (-self.priority.get(job, 0.0),
+                                        self.index[job], job))
+
+    def pop(self):
+        if self.priority is None:
+            return self.items.popleft()
+        return heapq.heappop(self.items)[2]
+
+    def __len__(self):
+        return len(self.items)
+
+
+def toposort(jobs, depends=None, priority=None):
+    return Graph(jobs, depends).toposort(priority)
+
+
+def _run_sequential(graph, func, keep_going, priority=None):
+    failures = []
+    blocked = set()
+    for job in graph.toposort(priority):
+        if job in blocked:
+            continue
+        try:
+            func(job)
+        except Exception as e:
+            _logger.error("%s failed: %s", job, e, extra={"cell": job})
+            failures.append((job, e))
+            if not keep_going:
+                break
+            blocked.update(graph.downstream(job))
+    return failures, blocked
+
+
+def _run_parallel(graph, func, num_workers, keep_going, priority=None):
+    graph.toposort()
+
+    cond = threading.Condition()
+    pending = dict((job, len(graph.depends[job])) for job in graph.jobs)
+    ready = _ReadyQueue(graph, priority)
+    for job in graph.jobs:
+        if not pending[job]:
+            ready.push(job)
+    state = dict(running=0, stop=False)
+    failures = []
+    blocked = set()
+
+    def next_job():
+        with cond:
+            while not state["stop"]:
+                if ready:
+                    state["running"] += 1
+                    return ready.pop()
+                if not state["running"]:
+                    return None
+                cond.wait(0.2)
+            return None
+
+    def job_done(job, error):
+        with cond:
+            state["running"] -= 1
+            if error is None:
+                for dep in graph.dependents[job]:
+                    pending[dep] -= 1
+                    if not pending[dep] and dep not in blocked:
+                        ready.push(dep)
+            else:
+                failures.append((job, error))
+                blocked.update(graph.downstream(job))
+                if not keep_going:
+                    state["stop"] = True
+            cond.notify_all()
+
+    def worker():
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            error = None
+            try:
+                func(job)
+            except Exception as e:
+                _logger.error("%s failed: %s", job, e, extra={"cell": job})
+                error = e
+            job_done(job, error)
+
+    threads = [threading.Thread(target=worker, name="build-worker-%d" % i)
+               for i in range(num_workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # join with a timeout so Ctrl-C still reaches the main thread
+        while t.is_alive():
+            t.join(0.2)
+    return failures, blocked
+
+
+def run_jobs(jobs, func, num_workers=1, keep_going=False, depends=None,
+             priority=None):
+    graph = Graph(jobs, depends)
+    num_workers = max(1, min(num_workers or 1, len(graph.jobs) or 1))
+    if num_workers == 1:
+        failures, blocked = _run_sequential(graph, func, keep_going,
+                                            priority)
+    else:
+        failures, blocked = _run_parallel(graph, func, num_workers,
+                                          keep_going, priority)
+    for job in graph.jobs:
+        if job in blocked:
+            _logger.warning("%s skipped, a dependency failed", job,
+                            extra={"cell": job})
+    if failures:
+        raise JobsFailed(failures, [x for x in graph.jobs if x in blocked])
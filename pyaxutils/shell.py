@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+if __package__:
+    from . import utils
+else:
+    import utils
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+CACHE_FILE = os.path.join(utils.CACHE_DIR, "shell.json")
+
+_shell_cache = {}
+_shell_lock = threading.Lock()
+
+
+def _exe_names(name):
+    if sys.platform != "win32" or os.path.splitext(name)[1]:
+        return [name]
+    exts = os.environ.get("PATHEXT", ".COM;.EXE;.BAT;.CMD")
+    return [name + x.lower() for x in exts.split(os.pathsep) if x]
+
+
+def _search_path(path):
+    return [x for x in (path or "").split(os.pathsep) if x]
+
+
+def which(name, path=None):
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+    names = _exe_names(name)
+    for dirname in _search_path(path):
+        for x in names:
+            filename = os.path.join(dirname, x)
+            if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                return filename
+    return None
+
+
+def _normkey(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def shell_root(sh):
+    # msys keeps sh in <root>/bin, msys2 and git for windows in <root>/usr/bin
+    root = os.path.dirname(os.path.abspath(sh))
+    if os.path.basename(root).lower() == "bin":
+        root = os.path.dirname(root)
+        if os.path.basename(root).lower() == "usr":
+            root = os.path.dirname(root)
+    return root
+
+
+def read_mounts(root):
+    # the mount table msys sh resolves paths with, read from its fstab
+    # instead of asking the shell
+    mounts = [(_normkey(root), "/")]
+    try:
+        with open(os.path.join(root, "etc", "fstab")) as fd:
+            for line in fd:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) < 2:
+                    continue
+                src, dst = [x.replace("\\040", " ") for x in fields[:2]]
+                if dst.startswith("/"):
+                    mounts.append((_normkey(src), dst.rstrip("/") or "/"))
+    except (IOError, OSError):
+        pass
+    # longest prefix wins
+    mounts.sort(key=lambda x: len(x[0]), reverse=True)
+    return mounts
+
+
+def translate_path(path, mounts=()):
+    path = os.path.abspath(path)
+    if os.name != "nt":
+        return path
+    key = os.path.normcase(path)
+    for src, dst in mounts:
+        if key == src or key.startswith(src.rstrip(os.sep) + os.sep):
+            rest = path[len(src):].replace(os.sep, "/").strip("/")
+            if not rest:
+                return dst
+            return "%s/%s" % (dst.rstrip("/"), rest)
+    drive, rest = os.path.splitdrive(path)
+    rest = rest.replace(os.sep, "/")
+    if drive.startswith(os.sep * 2):
+        return drive.replace(os.sep, "/") + rest
+    return "/%s%s" % (drive[0].lower(), rest or "/")
+
+
+class Shell:
+    def __init__(self, path, mounts=()):
+        self.path = path
+        self.mounts = [tuple(x) for x in mounts]
+
+    def __repr__(self):
+        return "<Shell path=%s>" % self.path
+
+
+def _find_sh(sh_path, mingw_dir, path):
+    # returns the shell path and the files whose change invalidates it
+    watched = []
+    if sh_path:
+        watched.append(sh_path)
+        return sh_path, watched
+    if mingw_dir:
+        sh = os.path.join(mingw_dir, "msys", "1.0", "bin", "sh.exe")
+        watched.append(sh)
+        if os.path.isfile(sh):
+            return sh, watched
+    for dirname in _search_path(path):
+        watched.append(dirname)
+        sh = which("sh", dirname)
+        if sh is not None:
+            watched.append(sh)
+            return sh, watched
+    return None, watched
+
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _discover(sh_path, mingw_dir, path, cache_file, refresh):
+    key = "%s|%s|%s" % (sh_path or "", mingw_dir or "", path)
+    cache = _load_cache(cache_file) if cache_file else {}
+    entry = cache.get(key)
+    if entry is not None and not refresh:
+        if all(utils.getmtime(x) == mtime for x, mtime in entry["mtimes"]):
+            return entry["path"], entry["mounts"]
+        logger.debug("%s is out of date for %s", cache_file, key)
+
+    sh, watched = _find_sh(sh_path, mingw_dir, path)
+    mounts = []
+    if sh is not None and os.name == "nt":
+        fstab = os.path.join(shell_root(sh), "etc", "fstab")
+        watched.append(fstab)
+        mounts = read_mounts(shell_root(sh))
+    if cache_file:
+        cache[key] = dict(path=sh,
+                          mounts=mounts,
+                          mtimes=[(x, utils.getmtime(x)) for x in watched])
+        utils.save_json(cache_file, cache)
+    return sh, mounts
+
+
+def find_sh(sh_path=None, mingw_dir=None, path=None, cache_file=None,
+            refresh=False):
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+    key = (sh_path, mingw_dir, path)
+    with _shell_lock:
+        if not refresh and key in _shell_cache:
+            return _shell_cache[key]
+        sh, mounts = _discover(sh_path, mingw_dir, path, cache_file, refresh)
+        shell = _shell_cache[key] = sh and Shell(sh, mounts)
+        logger.debug("sh=%s", sh)
+        return shell
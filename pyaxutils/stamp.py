@@ -0,0 +1,51 @@
+import hashlib
+import json
+import logging
+import os
+
+if __package__:
+    from . import utils
+else:
+    import utils
+
+_logger = logging.getLogger(
+    __package__ or os.path.basename(__file__))
+
+STAMP_FILENAME = ".build-stamps.json"
+
+
+def hash_value(value):
+    data = json.dumps(value, sort_keys=True, separators=(",", ":"),
+                      default=repr)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class Stamps:
+    def __init__(self, build_dir):
+        self.filename = os.path.join(build_dir, STAMP_FILENAME)
+        self._stamps = None
+
+    @property
+    def stamps(self):
+        if self._stamps is None:
+            try:
+                with open(self.filename) as fd:
+                    self._stamps = json.load(fd)
+            except (IOError, OSError, ValueError):
+                self._stamps = {}
+        return self._stamps
+
+    def is_fresh(self, step, fingerprint):
+        return self.stamps.get(step) == fingerprint
+
+    def update(self, step, fingerprint):
+        self.stamps[step] = fingerprint
+        self._save()
+
+    def invalidate(self, step):
+        if self.stamps.pop(step, None) is not None:
+            self._save()
+
+    def _save(self):
+        with utils.atomic_write(self.filename) as fd:
+            json.dump(self.stamps, fd, sort_keys=True)
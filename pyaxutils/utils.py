@@ -1,24 +1,145 @@
+import contextlib
 import logging
 import os
 import sys
 import copy
+import hashlib
 import json
+import marshal
+import re
+import threading
 
 _logger = logging.getLogger(
-    __package__ and __package__.name or os.path.basename(__file__))
+    __package__ or os.path.basename(__file__))
 
+_MISSING = object()
 
-def load_json(filename, default=None):
+
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
+
+# the caches of every module live under here
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pyaxutils")
+# directory for parsed json kept across processes, None to disable
+JSON_CACHE_DIR = None
+
+_json_cache = {}
+_json_lock = threading.Lock()
+
+
+def _json_loads(data):
+    if _fast_json is not None:
+        return _fast_json.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def _json_cache_file(filename):
+    return os.path.join(JSON_CACHE_DIR, "%s.py%d%d.marshal" % (
+        hashlib.sha1(filename.encode("utf-8")).hexdigest(),
+        sys.version_info[0], sys.version_info[1]))
+
+
+def _load_json_cache(filename, key):
     try:
-        with open(filename) as fd:
-            d = json.load(fd)
-            fd.close()
-            return d
-    except IOError:
+        with open(_json_cache_file(filename), "rb") as fd:
+            cached_key, data = marshal.load(fd)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return _MISSING
+    if tuple(cached_key) != key:
+        return _MISSING
+    return data
+
+
+def _save_json_cache(filename, key, data):
+    try:
+        with atomic_write(_json_cache_file(filename), "wb") as fd:
+            marshal.dump((key, data), fd)
+    except (IOError, OSError, ValueError) as e:
+        _logger.debug("cannot cache %s: %s", filename, e)
+
+
+def load_json(filename, default=None, copy=True):
+    # parsed files are cached per (path, mtime, size); copy=False hands out
+    # the cached object itself, which must then not be modified
+    filename = os.path.abspath(filename)
+    try:
+        st = os.stat(filename)
+    except (IOError, OSError):
         if default is not None:
-            return None
+            return default
         raise
-    pass
+    key = (filename, st.st_mtime, st.st_size)
+    data = _json_cache.get(key, _MISSING)
+    if data is _MISSING and JSON_CACHE_DIR:
+        data = _load_json_cache(filename, key)
+    if data is _MISSING:
+        with open(filename, "rb") as fd:
+            data = _json_loads(fd.read())
+        if JSON_CACHE_DIR:
+            _save_json_cache(filename, key, data)
+    if key not in _json_cache:
+        with _json_lock:
+            for k in [k for k in _json_cache if k[0] == filename]:
+                del _json_cache[k]
+            _json_cache[key] = data
+    return _deepcopy(data) if copy else data
+
+
+def replace(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+        return
+    # python 2 cannot rename over an existing file on windows
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w"):
+    # readers see the old file or the new one, never a partial write
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(),
+                            threading.current_thread().ident)
+    try:
+        with open(tmp, mode) as fd:
+            yield fd
+        replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save_json(filename, data):
+    # for caches, which are only ever worth a warning
+    try:
+        with atomic_write(filename) as fd:
+            json.dump(data, fd, indent=1, sort_keys=True)
+    except (IOError, OSError) as e:
+        _logger.warning("cannot write %s: %s", filename, e)
+
+
+def getmtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
 
 
 def get_by_platform(**kwargs):
@@ -69,6 +190,89 @@ def merge_keys_call(dst, src, dst_prefix=None, src_prefix=None, **kwargs):
             dst[dst_prefix + key] = v
 
 
+_PATH_TOKEN = re.compile(r"\.?([^.\[\]]+)|\[(-?\d+)\]")
+_path_cache = {}
+
+
+def _getitem(obj, key):
+    try:
+        return obj[key]
+    except (KeyError, IndexError):
+        return _MISSING
+    except TypeError:
+        if isinstance(key, int):
+            return _MISSING
+        return getattr(obj, key, _MISSING)
+
+
+class Path(object):
+    __slots__ = ("path", "keys")
+
+    def __init__(self, path, keys):
+        self.path = path
+        self.keys = keys
+
+    def __repr__(self):
+        return "<Path %s>" % (self.path,)
+
+    def get(self, obj, default=None):
+        for key in self.keys:
+            obj = _getitem(obj, key)
+            if obj is _MISSING:
+                return default
+        return obj
+
+    def set(self, obj, value):
+        # missing containers on the way are created as dicts
+        for key in self.keys[:-1]:
+            child = _getitem(obj, key)
+            if child is _MISSING or child is None:
+                child = obj[key] = {}
+            obj = child
+        obj[self.keys[-1]] = value
+        return value
+
+
+def compile_path(path):
+    # "toolchains.msvc141.arch.win64", "targets[0]" or a tuple of keys
+    if isinstance(path, list):
+        # the cache needs a hashable key
+        path = tuple(path)
+    compiled = _path_cache.get(path)
+    if compiled is not None:
+        return compiled
+    if isinstance(path, tuple):
+        keys = path
+    else:
+        keys = []
+        pos = 0
+        while pos < len(path):
+            m = _PATH_TOKEN.match(path, pos)
+            if not m or m.group(1) is not None and \
+                    m.group(0).startswith(".") != bool(pos):
+                raise ValueError("invalid path '%s' at %d" % (path, pos))
+            keys.append(m.group(1) if m.group(1) is not None
+                        else int(m.group(2)))
+            pos = m.end()
+        keys = tuple(keys)
+    if not keys:
+        raise ValueError("empty path")
+    compiled = _path_cache.setdefault(path, Path(path, keys))
+    return compiled
+
+
+def get_path(obj, path, default=None):
+    return compile_path(path).get(obj, default)
+
+
+def set_path(obj, path, value):
+    return compile_path(path).set(obj, value)
+
+
+def get_paths(obj, paths, default=None):
+    return [compile_path(path).get(obj, default) for path in paths]
+
+
 def keys(obj):
     if obj is None:
         return None
@@ -86,18 +290,147 @@ def transform(obj, *func, **kwfunc):
     return obj
 
 
-def merge(dst, *srcs):
-    for src in srcs:
-        for k in src:
-            if k in dst and isinstance(dst[k], dict):
-                merge(dst[k], src[k])
+LIST_REPLACE = "replace"
+LIST_APPEND = "append"
+LIST_UNIQUE = "unique"
+LIST_STRATEGIES = (LIST_REPLACE, LIST_APPEND, LIST_UNIQUE)
+
+
+def _merge_options(kwargs, **defaults):
+    for k in kwargs:
+        if k not in defaults:
+            raise TypeError("unexpected keyword argument '%s'" % k)
+    defaults.update(kwargs)
+    if defaults["lists"] not in LIST_STRATEGIES:
+        raise ValueError("unknown list strategy '%s'" % defaults["lists"])
+    return defaults
+
+
+def _merge_list(dst, src, strategy, copy_value):
+    if strategy == LIST_APPEND:
+        return dst + [copy_value(x) for x in src]
+    result = list(dst)
+    seen = set()
+    unhashable = []
+    for x in dst:
+        try:
+            seen.add(x)
+        except TypeError:
+            unhashable.append(x)
+    for x in src:
+        try:
+            if x in seen:
+                continue
+            seen.add(x)
+        except TypeError:
+            if x in unhashable:
+                continue
+            unhashable.append(x)
+        result.append(copy_value(x))
+    return result
+
+
+def _identity(x):
+    return x
+
+
+try:
+    _SCALARS = (type(None), bool, int, long, float, str, unicode)
+except NameError:
+    _SCALARS = (type(None), bool, int, float, str, bytes)
+
+
+def _deepcopy(obj):
+    # copy.deepcopy without recursion for the dicts and lists of parsed json
+    if type(obj) not in (dict, list):
+        return obj if isinstance(obj, _SCALARS) else copy.deepcopy(obj)
+
+    def new(v):
+        return {} if type(v) is dict else [None] * len(v)
+
+    root = new(obj)
+    stack = [(root, obj)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in (src.items() if type(src) is dict else enumerate(src)):
+            if type(v) in (dict, list):
+                dst[k] = new(v)
+                stack.append((dst[k], v))
+            elif isinstance(v, _SCALARS):
+                dst[k] = v
             else:
-                dst[k] = copy.deepcopy(src[k])
-            continue
-        continue
+                dst[k] = copy.deepcopy(v)
+    return root
+
+
+def merge(dst, *srcs, **kwargs):
+    # merges srcs into dst in place, without recursion; by default values
+    # taken from srcs are deep copies, copy=False shares them instead and
+    # copies a shared dict only once a later src merges into it
+    options = _merge_options(kwargs, lists=LIST_REPLACE, copy=True)
+    lists = options["lists"]
+    shared = set()
+
+    def share(v):
+        if isinstance(v, dict):
+            shared.add(id(v))
+        return v
+
+    copy_value = _deepcopy if options["copy"] else share
+    for src in srcs:
+        stack = [(dst, src)]
+        while stack:
+            d, s = stack.pop()
+            for k in s:
+                v = s[k]
+                cur = d.get(k)
+                if isinstance(cur, dict) and isinstance(v, dict):
+                    if id(cur) in shared:
+                        cur = d[k] = dict(cur)
+                        for x in cur.values():
+                            share(x)
+                    stack.append((cur, v))
+                elif lists != LIST_REPLACE and \
+                        isinstance(cur, list) and isinstance(v, list):
+                    d[k] = _merge_list(cur, v, lists, copy_value)
+                else:
+                    d[k] = copy_value(v)
     return dst
 
 
+def merged(*layers, **kwargs):
+    # returns a new merge of layers without touching any of them; unchanged
+    # branches are shared with the layers, only dicts on a changed path are
+    # copied, so the result must be treated as read-only
+    options = _merge_options(kwargs, lists=LIST_REPLACE)
+    lists = options["lists"]
+    owned = {}
+
+    def own(d):
+        if id(d) not in owned:
+            d = dict(d)
+            owned[id(d)] = d
+        return d
+
+    result = own({})
+    for layer in layers:
+        stack = [(result, layer)]
+        while stack:
+            d, s = stack.pop()
+            for k in s:
+                v = s[k]
+                cur = d.get(k)
+                if isinstance(cur, dict) and isinstance(v, dict):
+                    cur = d[k] = own(cur)
+                    stack.append((cur, v))
+                elif lists != LIST_REPLACE and \
+                        isinstance(cur, list) and isinstance(v, list):
+                    d[k] = _merge_list(cur, v, lists, _identity)
+                else:
+                    d[k] = v
+    return result
+
+
 if __name__ == "__main__":
 
     pass
@@ -0,0 +1,229 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+if __package__:
+    from . import fingerprint
+else:
+    import fingerprint
+
+logger = logging.getLogger(__package__ or os.path.basename(__file__))
+
+# a burst of changes ends once nothing changed for this long
+DEBOUNCE = 0.1
+POLL_INTERVAL = 1.0
+
+# sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")
+
+_fsdecode = getattr(os, "fsdecode", lambda x: x)
+
+
+def _fsencode(path):
+    # ctypes would hand a python 2 unicode path over as wchar_t *
+    if isinstance(path, bytes):
+        return path
+    if hasattr(os, "fsencode"):
+        return os.fsencode(path)
+    return path.encode(sys.getfilesystemencoding() or "utf-8")
+
+
+def _merge(changes, more):
+    # top -> set of changed paths, None when the whole tree must be rescanned
+    for top, paths in more.items():
+        if top in changes and changes[top] is None:
+            continue
+        if paths is None:
+            changes[top] = None
+        else:
+            changes.setdefault(top, set()).update(paths)
+
+
+class _Watcher:
+    def __init__(self, tops, ignore=fingerprint.IGNORE_PATTERNS, exclude=()):
+        self.tops = [os.path.abspath(x) for x in tops]
+        self.ignore = {}
+        for top in self.tops:
+            # build or dist dirs inside a source tree are not sources
+            patterns = list(ignore) + fingerprint.exclude_patterns(top,
+                                                                   exclude)
+            self.ignore[top] = (patterns, fingerprint.compile_ignore(patterns))
+
+    def ignored(self, top, path):
+        ignore_name, ignore_path = self.ignore[top][1]
+        if ignore_name and any(ignore_name(x) for x in path.split("/")):
+            return True
+        return bool(ignore_path and ignore_path(path))
+
+    def wait(self, timeout=None):
+        # blocks until something changed, then until DEBOUNCE passes
+        # without another change; {} when timeout runs out first
+        changes = {}
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if changes:
+                wait = DEBOUNCE
+            elif deadline is None:
+                wait = None
+            else:
+                wait = max(0.0, deadline - time.time())
+            more = self.read(wait)
+            if more:
+                _merge(changes, more)
+            elif changes or deadline is not None:
+                return changes
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(_Watcher):
+    def __init__(self, tops, ignore=fingerprint.IGNORE_PATTERNS, exclude=(),
+                 interval=POLL_INTERVAL):
+        _Watcher.__init__(self, tops, ignore, exclude)
+        self.interval = interval
+        self.files = dict((top, self.scan(top)) for top in self.tops)
+
+    def scan(self, top):
+        return fingerprint.scan(top, self.ignore[top][0])
+
+    def read(self, timeout=None):
+        time.sleep(self.interval if timeout is None
+                   else min(timeout, self.interval))
+        changes = {}
+        for top in self.tops:
+            old, new = self.files[top], self.scan(top)
+            paths = set(k for k in new if old.get(k) != new[k])
+            paths.update(k for k in old if k not in new)
+            if paths:
+                changes[top] = paths
+            self.files[top] = new
+        return changes
+
+
+class InotifyWatcher(_Watcher):
+    def __init__(self, tops, ignore=fingerprint.IGNORE_PATTERNS, exclude=()):
+        _Watcher.__init__(self, tops, ignore, exclude)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> (top, path of the directory in it)
+        self.watches = {}
+        try:
+            for top in self.tops:
+                self.add_tree(top, "")
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top, path):
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            wd = self.libc.inotify_add_watch(
+                self.fd, _fsencode(os.path.join(top, path)), WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    # gone again already
+                    continue
+                # ENOSPC: out of fs.inotify.max_user_watches
+                raise OSError(e, "cannot watch %s: %s" % (
+                    os.path.join(top, path), os.strerror(e)))
+            self.watches[wd] = (top, path)
+            try:
+                names = os.listdir(os.path.join(top, path))
+            except OSError:
+                continue
+            for name in names:
+                sub = path + "/" + name if path else name
+                if not self.ignored(top, sub) and \
+                        os.path.isdir(os.path.join(top, sub)) and \
+                        not os.path.islink(os.path.join(top, sub)):
+                    stack.append(sub)
+
+    def remove_tree(self, top, path):
+        prefix = path + "/"
+        for wd, (t, p) in list(self.watches.items()):
+            if t == top and (p == path or p.startswith(prefix)):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return {}
+            raise
+        if not readable:
+            return {}
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return {}
+            raise
+        changes = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + size]
+            offset += EVENT.size + size
+            if mask & IN_Q_OVERFLOW:
+                logger.debug("inotify queue overflow, rescanning")
+                return dict((top, None) for top in self.tops)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            top, path = self.watches[wd]
+            name = _fsdecode(name.rstrip(b"\0"))
+            if name:
+                path = path + "/" + name if path else name
+            if not path or self.ignored(top, path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(top, path)
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # its watches would keep reporting the old paths
+                self.remove_tree(top, path)
+            changes.setdefault(top, set()).add(path)
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watcher(tops, ignore=fingerprint.IGNORE_PATTERNS, exclude=()):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(tops, ignore, exclude)
+        except (OSError, AttributeError) as e:
+            logger.warning("cannot use inotify (%s), polling for changes", e)
+    return PollingWatcher(tops, ignore, exclude)
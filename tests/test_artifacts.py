@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyaxutils import artifacts
+
+
+def _write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fd:
+        fd.write(text)
+
+
+def _read(path):
+    with open(path) as fd:
+        return fd.read()
+
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = artifacts.ArtifactCache(os.path.join(self.tmp, "cache"))
+        self.src = os.path.join(self.tmp, "src")
+        _write(os.path.join(self.src, "a.txt"), "a")
+        _write(os.path.join(self.src, "b.txt"), "b")
+        self.cache.store("key", {"build": self.src})
+        self.out = os.path.join(self.tmp, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def object_of(self, rel):
+        for name, digest, _ in self.cache._load("key")["trees"]["build"]:
+            if name == rel:
+                return self.cache._object(digest)
+
+    def test_restore(self):
+        self.assertTrue(self.cache.restore("key", {"build": self.out}))
+        self.assertEqual(_read(os.path.join(self.out, "b.txt")), "b")
+        artifacts.unshare(self.out)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.out, artifacts.LINKS_FILENAME)))
+        _write(os.path.join(self.out, "a.txt"), "REBUILT")
+        self.assertEqual(_read(self.object_of("a.txt")), "a")
+
+    def test_partial_restore_is_unshared(self):
+        # an object evicted while restoring: a.txt is linked, b.txt fails
+        os.remove(self.object_of("b.txt"))
+        self.assertFalse(self.cache.restore("key", {"build": self.out}))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.out, artifacts.LINKS_FILENAME)))
+        artifacts.unshare(self.out)
+        _write(os.path.join(self.out, "a.txt"), "REBUILT")
+        self.assertEqual(_read(self.object_of("a.txt")), "a")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyaxutils import build, utils
+
+
+class SettingsTest(unittest.TestCase):
+    def test_empty_settings_are_true(self):
+        self.assertTrue(build.Settings())
+        self.assertTrue(build.FrozenSettings())
+
+    def test_frozen_settings_are_deeply_read_only(self):
+        data = dict(env=dict(A="1", nested=dict(x=[1, dict(y=2)])),
+                    depends=["a"])
+        settings = build.FrozenSettings(**data)
+        self.assertRaises(TypeError, settings.set, "env", {})
+        self.assertRaises(TypeError, settings.env.__setitem__, "B", "2")
+        self.assertRaises(TypeError, settings.env.update, B="2")
+        self.assertRaises(TypeError, settings.env["nested"]["x"][1].pop, "y")
+        self.assertEqual(settings.depends, ("a",))
+        self.assertEqual(data, dict(env=dict(A="1",
+                                             nested=dict(x=[1, dict(y=2)])),
+                                    depends=["a"]))
+        # still plain json and hashable
+        self.assertEqual(json.loads(json.dumps(settings.env)), data["env"])
+        self.assertEqual(hash(settings), hash(build.FrozenSettings(**data)))
+
+
+class TargetSettingsResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.src_dir, "a"))
+        self.filename = os.path.join(self.src_dir, "a",
+                                     build.BUILD_SETTINGS_FILENAME)
+        with open(self.filename, "w") as fd:
+            json.dump(dict(env=dict(A="1"),
+                           win64=dict(env=dict(A="64"), disable=True)), fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+
+    def test_resolve(self):
+        resolver = build.TargetSettingsResolver(self.src_dir)
+        win32 = resolver.resolve("a", "win32", "msvc141", "Debug")
+        self.assertEqual(win32.env, dict(A="1"))
+        self.assertFalse(win32.disable)
+        self.assertEqual(win32.configure, "configure")
+        win64 = resolver.resolve("a", "win64", "msvc141", "Release")
+        self.assertEqual(win64.env, dict(A="64"))
+        self.assertTrue(win64.disable)
+        self.assertIs(resolver.resolve("a", "win32", "msvc141", "Release"),
+                      win32)
+
+    def test_load_json_cache_stays_intact(self):
+        resolver = build.TargetSettingsResolver(self.src_dir)
+        settings = resolver.resolve("a", "win32", "msvc141", "Debug")
+        self.assertRaises(TypeError, settings.env.__setitem__, "A", "2")
+        self.assertEqual(utils.load_json(self.filename, copy=False)["env"],
+                         dict(A="1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
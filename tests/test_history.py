@@ -0,0 +1,55 @@
+import logging
+import unittest
+
+from pyaxutils import history
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = _Collect()
+        history.logger.addHandler(self.handler)
+        self.level = history.logger.level
+        history.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        history.logger.removeHandler(self.handler)
+        history.logger.setLevel(self.level)
+
+    def test_failed_cells_are_not_done(self):
+        progress = history.Progress(["a", "b", "c"], {})
+        for cell in "abc":
+            progress.start(cell)
+        progress.finish("a")
+        progress.finish("b", failed=True)
+        progress.finish("c")
+        self.assertEqual(self.handler.messages, [
+            "1/3 cells done",
+            "1/3 cells done, 1 failed",
+            "2/3 cells done, 1 failed",
+        ])
+
+    def test_eta(self):
+        progress = history.Progress(["a", "b", "c"], dict(a=10.0, b=20.0),
+                                    num_workers=1)
+        progress.finish("a")
+        # c takes the average of the known cells
+        self.assertEqual(self.handler.messages,
+                         ["1/3 cells done, about 35s left"])
+
+    def test_format_duration(self):
+        self.assertEqual(history.format_duration(59.4), "59s")
+        self.assertEqual(history.format_duration(61), "1m01s")
+        self.assertEqual(history.format_duration(3660), "1h01m")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pyaxutils import jobserver
+
+# each job notes when it starts and ends, in the order they happen
+MAKEFILE = """\
+JOBS = 1 2 3 4 5 6
+all: $(JOBS)
+$(JOBS):
+\t@echo + >> log; sleep 0.2; echo - >> log
+.PHONY: all $(JOBS)
+"""
+
+
+def _which(name):
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+
+@unittest.skipIf(sys.platform == "win32", "the posix jobserver")
+class JobserverTest(unittest.TestCase):
+    def test_create(self):
+        js = jobserver.Jobserver.create(3, "s -k --jobserver-auth=9,9")
+        try:
+            self.assertEqual(js.makeflags, "-j3 --jobserver-auth=%s -s -k"
+                             % js.server.auth)
+            self.assertEqual(js.environ, dict(MAKEFLAGS=js.makeflags))
+            # the implicit token and two from the pipe
+            tokens = [js.acquire() for _ in range(3)]
+            self.assertEqual(tokens, [None, jobserver.TOKEN, jobserver.TOKEN])
+            self.assertIsNone(js.server.wait(0))
+            for token in tokens:
+                js.release(token)
+        finally:
+            js.close()
+
+    def test_inherit(self):
+        js = jobserver.Jobserver.create(2)
+        try:
+            child = jobserver.setup(8, dict(MAKEFLAGS=js.makeflags))
+            self.assertTrue(child.inherited)
+            self.assertEqual(child.max_workers(1, 1), 1)
+            self.assertEqual(child.acquire(), None)
+            self.assertEqual(child.acquire(), jobserver.TOKEN)
+            child.close()
+            # the parent's descriptors stay open
+            os.fstat(js.server.read_fd)
+        finally:
+            js.close()
+
+    def test_plan_environ(self):
+        self.assertEqual(
+            jobserver.plan_environ(4, dict(MAKEFLAGS="k")),
+            dict(MAKEFLAGS="-j4 --jobserver-auth=%s -k"
+                 % jobserver.PLAN_AUTH))
+        # an inherited jobserver is passed on as is
+        self.assertEqual(
+            jobserver.plan_environ(4, dict(MAKEFLAGS="-j2 "
+                                           "--jobserver-auth=3,4")),
+            dict(MAKEFLAGS="-j2 --jobserver-auth=3,4"))
+
+    @unittest.skipIf(_which("make") is None, "needs GNU make")
+    def test_child_make_shares_tokens(self):
+        tmp = tempfile.mkdtemp()
+        js = jobserver.Jobserver.create(2)
+        try:
+            with open(os.path.join(tmp, "Makefile"), "w") as fd:
+                fd.write(MAKEFILE)
+            env = dict(os.environ)
+            env.update(js.environ)
+            token = js.acquire()
+            try:
+                subprocess.check_call(["make", "-s"], cwd=tmp, env=env,
+                                      close_fds=False)
+            finally:
+                js.release(token)
+            running = most = 0
+            with open(os.path.join(tmp, "log")) as fd:
+                for line in fd:
+                    running += 1 if line.strip() == "+" else -1
+                    most = max(most, running)
+            self.assertEqual(most, 2)
+        finally:
+            js.close()
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    unittest.main()
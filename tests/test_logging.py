@@ -0,0 +1,73 @@
+import logging
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pyaxutils import build, common, scheduler
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class CellHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("pyaxutils")
+        self.queue = queue.Queue()
+        self.handler = common.QueueHandler(self.queue)
+        self.listener = common.QueueListener(self.queue)
+        self.propagate = self.logger.propagate
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = self.propagate
+
+    def cell_handler(self, cell):
+        handler = _Collect()
+        self.listener.add_handler(handler, cell)
+        return handler
+
+    def run_jobs(self, num_workers):
+        def func(job):
+            if job == "c1":
+                raise RuntimeError("boom")
+
+        c1, c2 = self.cell_handler("c1"), self.cell_handler("c2")
+        with self.assertRaises(scheduler.JobsFailed):
+            scheduler.run_jobs(["c1", "c2"], func, num_workers=num_workers,
+                               keep_going=True, depends={"c2": ["c1"]})
+        self.listener.stop()
+        self.assertEqual(c1.messages, ["c1 failed: boom"])
+        self.assertEqual(c2.messages, ["c2 skipped, a dependency failed"])
+
+    def test_sequential(self):
+        self.run_jobs(1)
+
+    def test_parallel(self):
+        self.run_jobs(2)
+
+    def test_cell_logger(self):
+        cell = build.Cell("win64", "msvc141", "Release", "a")
+        handler = self.cell_handler(cell)
+        other = self.cell_handler("win64/msvc141/Release/b")
+        build.CellLogger(self.logger, cell).warning("%s done", "build")
+        self.listener.stop()
+        self.assertEqual(handler.messages,
+                         ["[win64/msvc141/Release/a] build done"])
+        self.assertEqual(other.messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from pyaxutils import msvc
+
+# a posix stand-in for vcvarsall.bat; it is sourced with the arch and
+# -vcvars_ver=... as its arguments and counts how often it runs
+VCVARSALL = """\
+echo "**********************************************"
+echo "** Visual Studio 2019 Developer Command Prompt"
+echo "BANNER=not a variable"
+echo run >> "%(runs)s"
+export VSCMD_ARG_TGT_ARCH="$1"
+export VCTOOLSVERSION="${2#-vcvars_ver=}"
+export PATH="/fake/vc/$1/bin:$PATH"
+"""
+
+
+def _make_tree(root, vs_ver="2019", vs_install="BuildTools",
+               toolsets=("14.16.27023",)):
+    vc = os.path.join(root, vs_ver, vs_install, "VC")
+    build = os.path.join(vc, "Auxiliary", "Build")
+    os.makedirs(build)
+    vcvarsall_bat = os.path.join(build, "vcvarsall.bat")
+    with open(vcvarsall_bat, "w") as fd:
+        fd.write(VCVARSALL % dict(runs=os.path.join(root, "runs")))
+    for toolset in toolsets:
+        os.makedirs(os.path.join(vc, "Tools", "MSVC", toolset))
+    return vcvarsall_bat
+
+
+def _installed(*toolsets):
+    return dict((x, [dict(toolset=x, vs_ver="2019", vs_install="BuildTools")])
+                for x in toolsets)
+
+
+class ToolsetIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = msvc.ToolsetIndex(_installed(
+            "14.9.1", "14.10.25017", "14.16.27023", "14.16.27040",
+            "14.29.30133"))
+
+    def test_find(self):
+        find = self.index.find
+        self.assertEqual(find(), "14.29.30133")
+        self.assertEqual(find("14.1"), "14.16.27040")
+        # numeric, not string order
+        self.assertEqual(find("14.", max_version="14.10"), "14.10.25017")
+        self.assertEqual(find("14.16.27023"), "14.16.27023")
+        self.assertIsNone(find("15"))
+
+    def test_bounds_are_inclusive(self):
+        find = self.index.find
+        self.assertEqual(find(max_version="14.16.27023"), "14.16.27023")
+        self.assertEqual(find(min_version="14.29.30133"), "14.29.30133")
+        self.assertIsNone(find(min_version="14.29.30134"))
+
+    def test_major_minor_bounds(self):
+        find = self.index.find
+        self.assertEqual(find("14.1", max_version="14.16"), "14.16.27040")
+        self.assertEqual(find(max_version="14.10"), "14.10.25017")
+        self.assertEqual(find(max_version="14"), "14.29.30133")
+        self.assertEqual(find(min_version="14.16", max_version="14.16"),
+                         "14.16.27040")
+        self.assertIsNone(find(max_version="14.8"))
+
+    def test_select(self):
+        installed = _installed("14.16.27023")
+        installed["14.16.27023"].append(dict(
+            toolset="14.16.27023", vs_ver="2017", vs_install="Community"))
+        index = msvc.ToolsetIndex(installed)
+        self.assertEqual(index.select("14.16.27023")["vs_ver"], "2019")
+        self.assertEqual(
+            index.select("14.16.27023", "Community")["vs_install"],
+            "Community")
+
+
+class DiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        _make_tree(self.root, "2019", "BuildTools",
+                   ("14.16.27023", "14.29.30133", "not-a-toolset"))
+        _make_tree(self.root, "2017", "Community", ("14.16.27023",))
+        # outside the root, whose mtime it would change
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.cache_dir, "installed.json")
+        self.scans = 0
+        self.scan_msvc = msvc.scan_msvc
+
+        def scan_msvc(roots):
+            self.scans += 1
+            return self.scan_msvc(roots)
+        msvc.scan_msvc = scan_msvc
+        msvc._index_cache.clear()
+
+    def tearDown(self):
+        msvc.scan_msvc = self.scan_msvc
+        msvc._index_cache.clear()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.cache_dir)
+
+    def test_default_roots(self):
+        environ = dict(os.environ)
+        try:
+            os.environ.pop("PROGRAMFILES(X86)", None)
+            os.environ.pop("PROGRAMFILES", None)
+            self.assertEqual(msvc.default_search_roots(), [])
+            os.environ["PROGRAMFILES(X86)"] = self.root
+            self.assertEqual(msvc.default_search_roots(), [
+                os.path.join(self.root, "Microsoft Visual Studio")])
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_nothing_installed(self):
+        self.assertRaises(RuntimeError, msvc.find_msvc, roots=[])
+
+    def test_scan(self):
+        installed = msvc.get_installed_msvc([self.root])
+        self.assertEqual(sorted(installed), ["14.16.27023", "14.29.30133"])
+        self.assertEqual(
+            [(x["vs_ver"], x["vs_install"]) for x in installed["14.16.27023"]],
+            [("2019", "BuildTools"), ("2017", "Community")])
+        found = msvc.find_msvc("14.16", roots=[self.root], prefer="2017")
+        self.assertEqual(found["vs_install"], "Community")
+
+    def test_memoized(self):
+        index = msvc.get_toolset_index([self.root])
+        self.assertIs(msvc.get_toolset_index([self.root]), index)
+        self.assertEqual(self.scans, 1)
+
+    def test_disk_cache(self):
+        msvc.get_toolset_index([self.root], self.cache_file)
+        self.assertTrue(os.path.isfile(self.cache_file))
+        # another process finds it up to date
+        msvc._index_cache.clear()
+        msvc.get_toolset_index([self.root], self.cache_file)
+        self.assertEqual(self.scans, 1)
+        # a new toolset changes the mtime of Tools/MSVC
+        os.makedirs(os.path.join(self.root, "2019", "BuildTools", "VC",
+                                 "Tools", "MSVC", "14.29.30140"))
+        msvc._index_cache.clear()
+        index = msvc.get_toolset_index([self.root], self.cache_file)
+        self.assertEqual(self.scans, 2)
+        self.assertEqual(index.find("14.29"), "14.29.30140")
+
+
+class ParseEnvironTest(unittest.TestCase):
+    def test_marker(self):
+        output = "\r\n".join([
+            "** Visual Studio 2019 Developer Command Prompt",
+            "BANNER=not a variable",
+            # cmd keeps the blank in "echo MARKER && set"
+            msvc.ENV_MARKER + " ",
+            "Path=C:\\VC\\bin",
+            "INCLUDE=C:\\VC\\include",
+        ])
+        env = msvc._parse_environ(output)
+        self.assertNotIn("BANNER", env)
+        self.assertEqual(env[msvc._env_key("INCLUDE")], "C:\\VC\\include")
+
+
+@unittest.skipIf(sys.platform == "win32", "a posix stand-in for vcvarsall")
+class CaptureEnvironTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.vcvarsall_bat = _make_tree(self.root)
+        self.cache_file = os.path.join(self.root, "cache", "environ.json")
+        msvc._environ_cache.clear()
+
+    def tearDown(self):
+        msvc._environ_cache.clear()
+        shutil.rmtree(self.root)
+
+    def runs(self):
+        try:
+            with open(os.path.join(self.root, "runs")) as fd:
+                return len(fd.readlines())
+        except IOError:
+            return 0
+
+    def environ(self, arch="x64", capture=True):
+        installed = msvc.find_msvc("14.16", roots=[self.root])
+        return msvc.MSVC(installed, arch, self.cache_file).environ(
+            dict(PATH="/usr/bin", HOME="/home/me"), capture)
+
+    def test_capture(self):
+        env = self.environ()
+        self.assertEqual(env["VSCMD_ARG_TGT_ARCH"], "x64")
+        self.assertEqual(env["VCTOOLSVERSION"], "14.16.27023")
+        self.assertEqual(env["PATH"], "/fake/vc/x64/bin:/usr/bin")
+        self.assertEqual(env["HOME"], "/home/me")
+        self.assertNotIn("BANNER", env)
+
+    def test_captured_once(self):
+        self.assertIsNone(self.environ(capture=False))
+        self.environ()
+        self.environ()
+        self.assertEqual(self.runs(), 1)
+        # a new process starts with the disk cache only
+        msvc._environ_cache.clear()
+        self.assertEqual(self.environ(capture=False)["VSCMD_ARG_TGT_ARCH"],
+                         "x64")
+        self.assertEqual(self.runs(), 1)
+        # every arch is a capture of its own
+        self.assertEqual(self.environ("x86")["VSCMD_ARG_TGT_ARCH"], "x86")
+        self.assertEqual(self.runs(), 2)
+
+    def test_vcvarsall_change(self):
+        self.environ()
+        st = os.stat(self.vcvarsall_bat)
+        os.utime(self.vcvarsall_bat, (st.st_atime, st.st_mtime + 10))
+        self.environ()
+        self.assertEqual(self.runs(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from pyaxutils import utils
+
+
+class MergeTest(unittest.TestCase):
+    def test_merge(self):
+        a = {"x": {"p": 1}, "l": [1]}
+        result = utils.merge({}, a, {"x": {"q": 2}, "l": [2]})
+        self.assertEqual(result, {"x": {"p": 1, "q": 2}, "l": [2]})
+        self.assertEqual(a, {"x": {"p": 1}, "l": [1]})
+
+    def test_merge_shared_leaves_srcs_alone(self):
+        a = {"x": {"p": 1, "n": {"z": 1}}}
+        b = {"x": {"q": 2, "n": {"y": 2}}}
+        result = utils.merge({}, a, b, {"x": {"n": {"w": 3}}}, copy=False)
+        self.assertEqual(result, {"x": {"p": 1, "q": 2,
+                                        "n": {"z": 1, "y": 2, "w": 3}}})
+        self.assertEqual(a, {"x": {"p": 1, "n": {"z": 1}}})
+        self.assertEqual(b, {"x": {"q": 2, "n": {"y": 2}}})
+
+    def test_merge_shared_keeps_untouched_branches(self):
+        a = {"x": {"p": 1}, "y": {"q": 2}}
+        result = utils.merge({}, a, {"x": {"r": 3}}, copy=False)
+        self.assertIs(result["y"], a["y"])
+        self.assertIsNot(result["x"], a["x"])
+
+    def test_merge_lists(self):
+        a = {"l": [1, 2]}
+        b = {"l": [2, 3]}
+        self.assertEqual(utils.merge({}, a, b, lists=utils.LIST_APPEND),
+                         {"l": [1, 2, 2, 3]})
+        self.assertEqual(utils.merge({}, a, b, lists=utils.LIST_UNIQUE),
+                         {"l": [1, 2, 3]})
+
+
+class PathTest(unittest.TestCase):
+    def test_get_path(self):
+        d = {"a": {"b": [1, 2]}}
+        self.assertEqual(utils.get_path(d, "a.b[1]"), 2)
+        self.assertEqual(utils.get_path(d, ["a", "b"]), [1, 2])
+        self.assertEqual(utils.get_path(d, ("a", "c"), 0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()